@@ -1,4 +1,6 @@
 import apt_pkg
 apt_pkg.init()
 
-__all__ = ['archive', 'defaults', 'germinator', 'log', 'seeds', 'version']
+__all__ = [
+    'archive', 'defaults', 'fetch', 'germinator', 'log', 'seeds', 'version',
+    ]
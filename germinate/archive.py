@@ -20,28 +20,28 @@
 # 02110-1301, USA.
 
 
-from __future__ import print_function
-
-import codecs
-from contextlib import closing, contextmanager
-import io
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 import logging
 import os
+import re
 import shutil
-import subprocess
-import sys
 import tempfile
-try:
-    from urllib.parse import quote
-    from urllib.request import Request, urlopen
-except ImportError:
-    from urllib import quote
-    from urllib2 import Request, urlopen
+import time
+from urllib.parse import quote
+from urllib.request import Request, url2pathname
 
 import apt_pkg
 
-
-__pychecker__ = 'no-reuseattr'
+from germinate.fetch import (
+    ChecksumMismatch,
+    FETCH_WORKERS,
+    NotModified,
+    add_validators,
+    download,
+    locked,
+    sha256sum,
+    )
 
 
 _logger = logging.getLogger(__name__)
@@ -51,23 +51,76 @@ def _progress(msg, *args, **kwargs):
     _logger.info(msg, *args, extra={'progress': True}, **kwargs)
 
 
-if sys.version >= '3':
-    _string_types = str
-else:
-    _string_types = basestring
+# Files named after their checksums are removed from a cache directory
+# once they have gone unused for this long.
+_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+
+_checksum_name = re.compile(r'^[0-9a-f]{64}_')
+
+
+def default_cache_dir():
+    """Return the default directory for caching downloaded index files."""
+    cache_home = os.environ.get('XDG_CACHE_HOME')
+    if not cache_home:
+        cache_home = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'germinate')
 
-if sys.version >= '3.1':
-    def get_request_type(req):
-        return req.type
 
-    def get_request_selector(req):
-        return req.selector
-else:
-    def get_request_type(req):
-        return req.get_type()
+def _prune_cache(dirname):
+    """Remove stale checksum-named files from a cache directory.
 
-    def get_request_selector(req):
-        return req.get_selector()
+    Lock files are never removed; see germinate.fetch.locked.
+
+    """
+    cutoff = time.time() - _CACHE_MAX_AGE
+    for name in os.listdir(dirname):
+        if not _checksum_name.match(name) or name.endswith(".lock"):
+            continue
+        path = os.path.join(dirname, name)
+        try:
+            if os.stat(path).st_mtime < cutoff:
+                os.unlink(path)
+        except OSError:
+            pass
+
+
+# Compression formats to look for, in order of preference.
+_SUFFIXES = (".xz", ".bz2", ".gz", "")
+
+
+def _strip_suffix(path):
+    """Return path without any compression suffix."""
+    for suffix in _SUFFIXES:
+        if suffix and path.endswith(suffix):
+            return path[:-len(suffix)]
+    return path
+
+
+def _parse_release(path):
+    """Parse the list of files from a Release file.
+
+    Returns a dictionary mapping paths relative to the dist to their SHA256
+    checksums, or to None if the Release file does not have SHA256
+    checksums for them.
+
+    """
+    files = {}
+    try:
+        with apt_pkg.TagFile(path) as tag_file:
+            for section in tag_file:
+                for field in ("MD5Sum", "SHA1", "SHA256"):
+                    for line in section.get(field, "").splitlines():
+                        words = line.split()
+                        if len(words) != 3:
+                            continue
+                        if field == "SHA256":
+                            files[words[2]] = words[0]
+                        else:
+                            files.setdefault(words[2], None)
+                break
+    except SystemError:
+        _logger.warning("Could not parse %s", path)
+    return files
 
 
 class IndexType:
@@ -97,15 +150,27 @@ class TagFile(Archive):
     """Fetch package lists from a Debian-format archive as apt tag files."""
 
     def __init__(self, dists, components, arch, mirrors, source_mirrors=None,
-                 installer_packages=True, cleanup=False, archive_exceptions=[]):
-        """Create a representation of a Debian-format apt archive."""
-        if isinstance(dists, _string_types):
+                 installer_packages=True, cleanup=False, archive_exceptions=[],
+                 fields=None, cache_dir=None):
+        """Create a representation of a Debian-format apt archive.
+
+        Downloaded files are cached in cache_dir, or in the current
+        directory if that is None, unless cleanup is true in which case
+        they are put in a temporary directory and removed afterwards.
+
+        If fields is given, it maps each IndexType to the control fields
+        that the caller needs from sections of that type; sections are
+        then yielded as plain dictionaries containing only those fields,
+        rather than as apt_pkg.TagSection objects.
+
+        """
+        if isinstance(dists, str):
             dists = [dists]
-        if isinstance(components, _string_types):
+        if isinstance(components, str):
             components = [components]
-        if isinstance(mirrors, _string_types):
+        if isinstance(mirrors, str):
             mirrors = [mirrors]
-        if isinstance(source_mirrors, _string_types):
+        if isinstance(source_mirrors, str):
             source_mirrors = [source_mirrors]
 
         self._dists = dists
@@ -118,90 +183,116 @@ class TagFile(Archive):
         else:
             self._source_mirrors = mirrors
         self._cleanup = cleanup
+        self._cache_dir = cache_dir
         self._archive_exceptions = archive_exceptions
+        self._fields = fields
+        # (mirror, dist) -> {path: SHA256 checksum or None}
+        self._release_files = {}
+
+    def _fetch(self, mirror, dirname, dist, path, checksum=None):
+        """Download a file from a dist if needed, returning its local path.
+
+        Files from local mirrors are used in place.  Compressed files are
+        left compressed; apt_pkg.TagFile decompresses them itself based on
+        the file name extension.
+
+        If the file's SHA256 checksum is known from the Release file, then
+        a cached copy with that checksum is used without checking the
+        mirror at all.  In a persistent cache directory, such files are
+        named after their checksums, so that _prune_cache can tell which
+        ones have fallen out of use; elsewhere, a file keeps the same name
+        from one run to the next so that old copies do not pile up.
+        Other cached files are revalidated with the mirror, or fetched
+        afresh if there is nothing to revalidate them with.
 
-    def _open_tag_files(self, mirrors, dirname, tagfile_type,
-                        dist, component, ftppath, archive_exceptions=[]):
-        def _open_tag_file(mirror, suffix):
-            """Download an apt tag file if needed, then open it."""
-            if not mirror.endswith('/'):
-                mirror += '/'
-            url = (mirror + "dists/" + dist + "/" + component + "/" + ftppath +
-                   suffix)
-            req = Request(url)
-            filename = None
-
-            if get_request_type(req) != "file":
-                filename = "%s_%s_%s_%s" % (quote(mirror, safe=""),
-                                            quote(dist, safe=""),
-                                            component, tagfile_type)
+        """
+        if not mirror.endswith('/'):
+            mirror += '/'
+        req = Request(mirror + "dists/" + dist + "/" + path)
+
+        if req.type == "file":
+            # Check that the file exists, so that a missing one makes our
+            # caller try something else.
+            local_path = url2pathname(req.selector)
+            os.stat(local_path)
+            _progress("Using %s file ...", req.get_full_url())
+            return local_path
+
+        prefix = "%s_%s_" % (quote(mirror, safe=""), quote(dist, safe=""))
+        persistent = dirname == self._cache_dir
+        by_checksum = persistent and checksum is not None
+        if by_checksum:
+            filename = "%s_%s" % (checksum, path.rsplit("/", 1)[-1])
+        else:
+            filename = prefix + path.replace("/", "_")
+        fullname = os.path.join(dirname, filename)
+        if persistent:
+            # Other processes may be using the same cache directory.  Take
+            # one lock per index, whichever compressed form of it we are
+            # trying, so that probing for each form doesn't leave a lock
+            # file behind for each one.
+            lock = locked(os.path.join(
+                dirname, prefix + _strip_suffix(path).replace("/", "_")))
+        else:
+            lock = nullcontext()
+        with lock:
+            try:
+                os.stat(fullname)
+                cached = True
+            except OSError:
+                cached = False
+
+            if checksum is not None:
+                if cached and not by_checksum:
+                    cached = sha256sum(fullname) == checksum
+                if cached:
+                    if by_checksum:
+                        # Record the use, for the benefit of _prune_cache.
+                        os.utime(fullname, None)
+                else:
+                    _progress("Downloading %s file ...", req.get_full_url())
+                    download(req, fullname, checksum=checksum)
+            elif not cached:
+                _progress("Downloading %s file ...", req.get_full_url())
+                download(req, fullname)
             else:
-                # Make a more or less dummy filename for local URLs.
-                filename = os.path.split(get_request_selector(req))[0].replace(
-                    os.sep, "_")
-
-            fullname = os.path.join(dirname, filename)
-            if get_request_type(req) == "file":
-                # Always refresh.  TODO: we should use If-Modified-Since for
-                # remote HTTP tag files.
+                # Revalidate our cached copy; with no validators, this
+                # fetches it again.  If we can't, we just use it as it is.
+                add_validators(req, fullname)
                 try:
-                    os.unlink(fullname)
-                except OSError:
+                    download(req, fullname)
+                    _progress("Downloaded updated %s file",
+                              req.get_full_url())
+                except NotModified:
                     pass
-            if not os.path.exists(fullname):
-                _progress("Downloading %s file ...", req.get_full_url())
+                except (IOError, OSError):
+                    _logger.warning("Could not check whether %s is up to "
+                                    "date; using cached copy",
+                                    req.get_full_url())
 
-                compressed = os.path.join(dirname, filename + suffix)
-                try:
-                    with closing(urlopen(req)) as url_f, \
-                         open(compressed, "wb") as compressed_f:
-                        compressed_f.write(url_f.read())
-
-                    # apt_pkg is weird and won't accept GzipFile
-                    if suffix:
-                        _progress("Decompressing %s file ...",
-                                  req.get_full_url())
-
-                        if suffix == ".gz":
-                            import gzip
-                            decompressor = gzip.GzipFile
-                        elif suffix == ".bz2":
-                            import bz2
-                            decompressor = bz2.BZ2File
-                        elif suffix == ".xz":
-                            if sys.version >= "3.3":
-                                import lzma
-                                decompressor = lzma.LZMAFile
-                            else:
-                                @contextmanager
-                                def decompressor(name):
-                                    proc = subprocess.Popen(
-                                        ["xzcat", name],
-                                        stdout=subprocess.PIPE)
-                                    yield proc.stdout
-                                    proc.stdout.close()
-                                    proc.wait()
-                        else:
-                            raise RuntimeError("Unknown suffix '%s'" % suffix)
-
-                        with decompressor(compressed) as compressed_f, \
-                             open(fullname, "wb") as f:
-                            f.write(compressed_f.read())
-                            f.flush()
-                finally:
-                    if suffix:
-                        try:
-                            os.unlink(compressed)
-                        except OSError:
-                            pass
-
-            if sys.version_info[0] < 3:
-                return codecs.open(fullname, 'r', 'UTF-8', 'replace')
-            else:
-                return io.open(fullname, mode='r', encoding='UTF-8',
-                               errors='replace')
+        return fullname
+
+    def _fetch_release(self, mirror, dirname, dist):
+        """Fetch the Release file for a dist, returning its local path.
+
+        Returns None if there is no Release file.  This is run in a worker
+        thread, so it must not touch apt_pkg.
+
+        """
+        try:
+            return self._fetch(mirror, dirname, dist, "Release")
+        except (IOError, OSError):
+            return None
 
+    def _open_tag_files(self, mirrors, dirname, tagfile_type,
+                        dist, component, ftppath, archive_exceptions=[]):
+        """Fetch a tag file from each of mirrors, returning local paths.
+
+        This is run in a worker thread, so it must not touch apt_pkg.
+
+        """
         tag_files = []
+        prefix = component + "/" + ftppath
         for mirror in mirrors:
             tag_file = None
             some_mirrors_processed = False
@@ -216,9 +307,30 @@ class TagFile(Archive):
             else:
                 some_mirrors_processed = True
 
-            for suffix in (".xz", ".bz2", ".gz", ""):
+            suffixes = _SUFFIXES
+            release_files = self._release_files.get((mirror, dist), {})
+            if release_files:
+                # Only try the compression formats that the Release file
+                # says exist, if it mentions any.
+                listed = [
+                    suffix for suffix in _SUFFIXES
+                    if prefix + suffix in release_files]
+                if listed:
+                    suffixes = listed
+
+            for suffix in suffixes:
                 try:
-                    tag_file = _open_tag_file(mirror, suffix)
+                    path = prefix + suffix
+                    try:
+                        tag_file = self._fetch(
+                            mirror, dirname, dist, path,
+                            checksum=release_files.get(path))
+                    except ChecksumMismatch as e:
+                        # Most likely the mirror is part-way through an
+                        # update, and its index files are still older than
+                        # its Release file.
+                        _logger.warning("%s; using it unverified", e)
+                        tag_file = self._fetch(mirror, dirname, dist, path)
                     tag_files.append(tag_file)
                     break
                 except (IOError, OSError):
@@ -239,59 +351,102 @@ class TagFile(Archive):
         """
         if self._cleanup:
             dirname = tempfile.mkdtemp(prefix="germinate-")
+        elif self._cache_dir is not None:
+            dirname = self._cache_dir
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
         else:
             dirname = '.'
 
-        try:
-            for dist in self._dists:
-                for component in self._components:
-                    packages = self._open_tag_files(
-                        self._mirrors, dirname, "Packages", dist, component,
-                        "binary-" + self._arch + "/Packages", self._archive_exceptions)
-                    for tag_file in packages:
-                        try:
-                            for section in apt_pkg.TagFile(tag_file):
-                                yield (IndexType.PACKAGES, section)
-                        finally:
-                            tag_file.close()
+        # Each job is (IndexType, missing message, arguments to
+        # _open_tag_files), where a missing message is a tuple of logging
+        # arguments.  Jobs with a missing message may fail without aborting
+        # the whole run.
+        jobs = []
+        packages_path = "binary-" + self._arch + "/Packages"
+        installer_path = "debian-installer/" + packages_path
+        for dist in self._dists:
+            for component in self._components:
+                jobs.append((
+                    IndexType.PACKAGES, None,
+                    (self._mirrors, dirname, "Packages", dist, component,
+                     packages_path,
+                     self._archive_exceptions)))
+                jobs.append((
+                    IndexType.SOURCES,
+                    ("Missing Source Packages file for %s (ignoring)",
+                     component),
+                    (self._source_mirrors, dirname, "Sources", dist,
+                     component, "source/Sources")))
+                if self._installer_packages:
+                    jobs.append((
+                        IndexType.INSTALLER_PACKAGES,
+                        ("Missing installer Packages file for %s "
+                         "(ignoring)", component),
+                        (self._mirrors, dirname, "InstallerPackages", dist,
+                         component, installer_path,
+                         self._archive_exceptions)))
+
+        arches = (self._arch, "all")
+        # apt_pkg itself is initialised once, when the germinate package is
+        # imported; apt_pkg.TagFile parsers cannot be reused across files,
+        # but at least avoid looking the class up again for each one.
+        open_tag_file = apt_pkg.TagFile
 
+        try:
+            # Downloads are dominated by network latency, so start them all
+            # at once and then parse the results in order as they arrive.
+            with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+                # Fetch the Release files first, so that we know which
+                # index files exist without having to probe for them.
+                releases = []
+                for dist in self._dists:
+                    for mirror in self._mirrors + [
+                            mirror for mirror in self._source_mirrors
+                            if mirror not in self._mirrors]:
+                        releases.append((mirror, dist, executor.submit(
+                            self._fetch_release, mirror, dirname, dist)))
+                for mirror, dist, future in releases:
+                    path = future.result()
+                    if path is not None:
+                        self._release_files[(mirror, dist)] = \
+                            _parse_release(path)
+
+                futures = [
+                    (index_type, missing,
+                     executor.submit(self._open_tag_files, *args))
+                    for index_type, missing, args in jobs]
+                for index_type, missing, future in futures:
                     try:
-                        sources = self._open_tag_files(
-                            self._source_mirrors, dirname, "Sources", dist,
-                            component, "source/Sources")
+                        paths = future.result()
                     except IOError:
+                        if missing is None:
+                            raise
                         # can live without these
-                        _progress("Missing Source Packages file for %s "
-                              "(ignoring)", component)
-                        sources = {}
-
-                    for tag_file in sources:
-                        try:
-                            for section in apt_pkg.TagFile(tag_file):
-                                yield (IndexType.SOURCES, section)
-                        finally:
-                            tag_file.close()
-
-                    instpackages = ""
-                    if self._installer_packages:
-                        try:
-                            instpackages = self._open_tag_files(
-                                self._mirrors, dirname, "InstallerPackages",
-                                dist, component,
-                                "debian-installer/binary-" + self._arch +
-                                "/Packages", self._archive_exceptions)
-                        except IOError:
-                            # can live without these
-                            _progress("Missing installer Packages file for %s "
-                                      "(ignoring)", component)
-                        else:
-                            for tag_file in instpackages:
-                                try:
-                                    for section in apt_pkg.TagFile(tag_file):
-                                        yield (IndexType.INSTALLER_PACKAGES,
-                                               section)
-                                finally:
-                                    tag_file.close()
+                        _progress(*missing)
+                        continue
+                    if self._fields is not None:
+                        fields = self._fields[index_type]
+                    else:
+                        fields = None
+                    check_arch = index_type != IndexType.SOURCES
+                    for path in paths:
+                        with open_tag_file(path) as tag_file:
+                            for section in tag_file:
+                                if check_arch:
+                                    # Skip entries for other architectures
+                                    # before doing any more work on them.
+                                    arch = section.get("Architecture")
+                                    if arch and arch not in arches:
+                                        continue
+                                if fields is not None:
+                                    section = dict(
+                                        (field, section[field])
+                                        for field in fields
+                                        if field in section)
+                                yield (index_type, section)
         finally:
             if self._cleanup:
                 shutil.rmtree(dirname)
+            elif self._cache_dir is not None:
+                _prune_cache(dirname)
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""Downloading and caching files for Germinate."""
+
+# Copyright (c) 2004, 2005, 2006, 2007, 2008, 2009, 2010, 2011, 2012
+#               Canonical Ltd.
+#
+# Germinate is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any
+# later version.
+#
+# Germinate is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Germinate; see the file COPYING.  If not, write to the Free
+# Software Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+
+from contextlib import closing, contextmanager
+import fcntl
+import hashlib
+import os
+import shutil
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+try:
+    import urllib3
+except ImportError:
+    urllib3 = None
+
+
+__all__ = [
+    'ChecksumMismatch',
+    'FETCH_WORKERS',
+    'NotModified',
+    'add_validators',
+    'download',
+    'locked',
+    'reset_connections',
+    'sha256sum',
+]
+
+
+# Number of files to fetch concurrently.
+FETCH_WORKERS = 8
+
+# Buffer size for copying downloaded files, which may be tens of megabytes;
+# we stream them rather than reading them into memory.
+_COPY_BUFSIZE = 1024 * 1024
+
+def _new_pool():
+    if urllib3 is None:
+        return None
+    # maxsize must be at least FETCH_WORKERS so that each worker can hold
+    # its own connection.
+    return urllib3.PoolManager(
+        num_pools=16, maxsize=32, retries=urllib3.Retry(total=3),
+        block=False)
+
+
+# Pooled HTTP connections, so that repeated fetches from the same mirror
+# reuse a kept-alive connection.
+_http = _new_pool()
+
+
+def reset_connections():
+    """Stop using any pooled HTTP connections made so far.
+
+    A process forked from one that has already made HTTP requests must
+    call this before making its own, or it and its parent may both use the
+    same kept-alive connection at once.
+
+    """
+    global _http
+    _http = _new_pool()
+
+
+@contextmanager
+def _released(resp):
+    try:
+        yield resp
+    finally:
+        resp.release_conn()
+
+
+@contextmanager
+def locked(path):
+    """Hold an exclusive lock on behalf of path.
+
+    This stops processes that share a cache directory from all downloading
+    the same file at once; whoever gets the lock second finds the file
+    already cached.  The lock file is left in place afterwards: removing
+    it would let another process lock a fresh file while the old one is
+    still held.
+
+    """
+    with open(path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+class NotModified(Exception):
+    """A conditional request found that our cached copy is current."""
+
+    pass
+
+
+class ChecksumMismatch(IOError):
+    """A download did not have the checksum that it was expected to."""
+
+    pass
+
+
+def _urlopen(req):
+    """Open a URL for reading, as a context manager.
+
+    HTTP URLs use the shared connection pool if urllib3 is available;
+    anything else (including file: URLs) goes through urllib.  Either way,
+    the body is returned exactly as sent, without undoing any
+    Content-Encoding.  Raises NotModified if the server answers a
+    conditional request with 304.
+
+    """
+    if _http is None or req.type not in ("http", "https"):
+        try:
+            return closing(urlopen(req))
+        except HTTPError as e:
+            if e.code == 304:
+                raise NotModified()
+            raise
+    url = req.get_full_url()
+    try:
+        # Like urllib, leave any Content-Encoding alone: a mirror that
+        # serves Packages.gz with "Content-Encoding: gzip" still means us to
+        # store the compressed file.
+        resp = _http.request('GET', url, headers=dict(req.header_items()),
+                             preload_content=False, decode_content=False)
+    except urllib3.exceptions.HTTPError as e:
+        raise IOError("Failed to fetch %s: %s" % (url, e))
+    if resp.status != 200:
+        resp.release_conn()
+        if resp.status == 304:
+            raise NotModified()
+        # Raise the same exception as urllib would, so that callers can
+        # tell what went wrong.
+        raise HTTPError(url, resp.status, resp.reason, resp.headers, None)
+    return _released(resp)
+
+
+# Cache validators are stored next to each downloaded file, in files with
+# these suffixes.
+_VALIDATORS = (
+    ('.etag', 'ETag', 'If-None-Match'),
+    ('.mtime', 'Last-Modified', 'If-Modified-Since'),
+)
+
+
+def add_validators(req, path):
+    """Make req conditional on the validators saved for path.
+
+    Returns True if any validators were found.
+
+    """
+    found = False
+    for suffix, _, request_header in _VALIDATORS:
+        try:
+            with open(path + suffix) as validator:
+                req.add_header(request_header, validator.read().strip())
+                found = True
+        except (IOError, OSError):
+            pass
+    return found
+
+
+def sha256sum(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_COPY_BUFSIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def download(req, path, checksum=None):
+    """Download req to path.
+
+    If checksum is given, the download must have that SHA256 checksum.
+    Otherwise, save any cache validators alongside the downloaded file.
+
+    """
+    # The cache directory may be shared with other processes fetching the
+    # same file at the same time.
+    new_path = '%s.new.%d' % (path, os.getpid())
+    try:
+        with _urlopen(req) as url_f, open(new_path, "wb") as f:
+            shutil.copyfileobj(url_f, f, _COPY_BUFSIZE)
+            headers = url_f.info()
+        if checksum is not None and sha256sum(new_path) != checksum:
+            raise ChecksumMismatch(
+                "Checksum mismatch for %s" % req.get_full_url())
+    except Exception:
+        # Don't leave a partial download lying around.
+        try:
+            os.unlink(new_path)
+        except OSError:
+            pass
+        raise
+    os.rename(new_path, path)
+
+    for suffix, response_header, _ in _VALIDATORS:
+        # Files with known checksums are never revalidated, so don't keep
+        # validators for them.
+        if checksum is None:
+            value = headers.get(response_header)
+        else:
+            value = None
+        if value is not None:
+            with open(path + suffix, "w") as validator:
+                validator.write(value + "\n")
+        else:
+            try:
+                os.unlink(path + suffix)
+            except OSError:
+                pass
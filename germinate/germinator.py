@@ -20,7 +20,8 @@
 
 from __future__ import print_function
 
-from collections import defaultdict, MutableMapping
+from collections import defaultdict
+from collections.abc import MutableMapping
 import fnmatch
 import logging
 import re
@@ -36,6 +37,7 @@ sys.setrecursionlimit(3000)
 
 
 __all__ = [
+    'ARCHIVE_FIELDS',
     'Germinator',
 ]
 
@@ -45,6 +47,22 @@ BUILD_DEPENDS = (
     "Build-Depends-Arch",
 )
 
+# The fields of archive index sections that Germinator.parse_archive uses.
+# Pass this as the fields argument to germinate.archive.TagFile to avoid
+# carrying the rest of each section around.
+_PACKAGE_FIELDS = (
+    "Package", "Version", "Section", "Maintainer", "Essential",
+    "Pre-Depends", "Depends", "Recommends", "Built-Using",
+    "Size", "Installed-Size", "Source", "Provides", "Multi-Arch",
+    "Kernel-Version",
+)
+ARCHIVE_FIELDS = {
+    IndexType.PACKAGES: _PACKAGE_FIELDS,
+    IndexType.SOURCES:
+        ("Package", "Version", "Maintainer", "Binary") + BUILD_DEPENDS,
+    IndexType.INSTALLER_PACKAGES: _PACKAGE_FIELDS,
+}
+
 _logger = logging.getLogger(__name__)
 
 
@@ -439,50 +457,51 @@ class Germinator(object):
             if apt_pkg.version_compare(last_ver, ver) >= 0:
                 return
 
-        self._packages[pkg] = {}
-        self._packagetype[pkg] = pkgtype
-
-        self._packages[pkg]["Section"] = \
-            section.get("Section", "").split('/')[-1]
-
-        self._packages[pkg]["Version"] = ver
-
-        self._packages[pkg]["Maintainer"] = \
-            _ensure_unicode(section.get("Maintainer", ""))
-
-        self._packages[pkg]["Essential"] = section.get("Essential", "")
+        # This runs for every package in the archive, so build the entry in
+        # a local dictionary, and don't ask apt_pkg to parse empty fields.
+        get = section.get
+        data = {
+            "Section": get("Section", "").split('/')[-1],
+            "Version": ver,
+            "Maintainer": _ensure_unicode(get("Maintainer", "")),
+            "Essential": get("Essential", ""),
+        }
 
         for field in "Pre-Depends", "Depends", "Recommends", "Built-Using":
-            value = section.get(field, "")
+            value = get(field)
+            if not value:
+                data[field] = []
+                continue
             try:
-                self._packages[pkg][field] = self._parse_depends(value)
+                data[field] = self._parse_depends(value)
             except ValueError:
                 if field == "Built-Using":
                     _logger.error(
                         "Package %s has invalid Built-Using: %s", pkg, value)
+                    data[field] = []
                 else:
                     raise
 
-        for field in "Size", "Installed-Size":
-            value = section.get(field, "0")
-            self._packages[pkg][field] = int(value)
+        data["Size"] = int(get("Size", "0"))
+        data["Installed-Size"] = int(get("Installed-Size", "0"))
 
-        src = section.get("Source", pkg)
+        src = get("Source", pkg)
         idx = src.find("(")
         if idx != -1:
             src = src[:idx].strip()
-        self._packages[pkg]["Source"] = src
+        data["Source"] = src
 
-        self._packages[pkg]["Provides"] = apt_pkg.parse_depends(
-            section.get("Provides", ""))
+        provides = get("Provides")
+        data["Provides"] = apt_pkg.parse_depends(provides) if provides else []
 
-        if pkg in self._provides:
-            self._provides[pkg].append(pkg)
+        data["Multi-Arch"] = get("Multi-Arch", "none")
+        data["Kernel-Version"] = get("Kernel-Version", "")
 
-        self._packages[pkg]["Multi-Arch"] = section.get("Multi-Arch", "none")
+        self._packages[pkg] = data
+        self._packagetype[pkg] = pkgtype
 
-        self._packages[pkg]["Kernel-Version"] = section.get(
-            "Kernel-Version", "")
+        if pkg in self._provides:
+            self._provides[pkg].append(pkg)
 
     def _strip_restrictions(self, value):
         # Work around lack of https://wiki.debian.org/BuildProfileSpec
@@ -577,18 +596,20 @@ class Germinator(object):
             if apt_pkg.version_compare(last_ver, ver) >= 0:
                 return
 
-        self._sources[src] = {}
-
-        self._sources[src]["Maintainer"] = \
-            _ensure_unicode(section.get("Maintainer", ""))
-        self._sources[src]["Version"] = ver
+        get = section.get
+        data = {
+            "Maintainer": _ensure_unicode(get("Maintainer", "")),
+            "Version": ver,
+        }
 
         for field in BUILD_DEPENDS:
-            value = section.get(field, "")
-            self._sources[src][field] = self._parse_src_depends(value)
+            value = get(field)
+            data[field] = self._parse_src_depends(value) if value else []
+
+        binaries = apt_pkg.parse_depends(get("Binary", src))
+        data["Binaries"] = [b[0][0] for b in binaries]
 
-        binaries = apt_pkg.parse_depends(section.get("Binary", src))
-        self._sources[src]["Binaries"] = [b[0][0] for b in binaries]
+        self._sources[src] = data
 
     def parse_archive(self, archive):
         """Parse an archive.
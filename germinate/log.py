@@ -33,18 +33,16 @@ class GerminateFormatter(logging.Formatter):
             logging.WARNING: '! ',
             logging.ERROR: '? ',
         }
+        self._level_prefix = self.levels.get
 
     def format(self, record):
-        try:
-            if record.progress:
-                return record.getMessage()
-        except AttributeError:
-            pass
-
-        try:
-            return '%s%s' % (self.levels[record.levelno], record.getMessage())
-        except KeyError:
-            return record.getMessage()
+        message = record.getMessage()
+        if getattr(record, 'progress', False):
+            return message
+        prefix = self._level_prefix(record.levelno)
+        if prefix is None:
+            return message
+        return prefix + message
 
 
 def germinate_logging(level):
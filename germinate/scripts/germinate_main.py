@@ -28,7 +28,7 @@ import sys
 
 import germinate.archive
 import germinate.defaults
-from germinate.germinator import Germinator
+from germinate.germinator import ARCHIVE_FIELDS, Germinator
 from germinate.log import germinate_logging
 from germinate.seeds import Seed, SeedError, SeedStructure, SeedVcs
 import germinate.version
@@ -97,7 +97,7 @@ def parse_options(argv):
                            'installed; use --vcs=bzr instead)')
     parser.add_option('--cleanup', dest='cleanup', action='store_true',
                       default=False,
-                      help="don't cache Packages or Sources files")
+                      help="don't cache Packages, Sources, or seed files")
     parser.add_option('--no-rdepends', dest='want_rdepends',
                       action='store_false', default=True,
                       help='disable reverse-dependency calculations')
@@ -151,15 +151,23 @@ def main(argv):
     archive = germinate.archive.TagFile(
         options.dist, options.components, options.arch,
         options.mirrors, source_mirrors=options.source_mirrors,
-        installer_packages=options.installer, cleanup=options.cleanup)
+        installer_packages=options.installer, cleanup=options.cleanup,
+        fields=ARCHIVE_FIELDS)
     g.parse_archive(archive)
 
     if os.path.isfile("hints"):
         with open("hints") as hints:
             g.parse_hints(hints)
 
+    if options.cleanup:
+        seed_cache_dir = None
+    else:
+        seed_cache_dir = os.path.join(
+            germinate.archive.default_cache_dir(), 'seeds')
     try:
-        structure = SeedStructure(options.release, options.seeds, options.vcs)
+        structure = SeedStructure(
+            options.release, options.seeds, options.vcs,
+            cache_dir=seed_cache_dir)
         for seed_package in options.seed_packages:
             parent, pkg = seed_package.split('/')
             structure.add(pkg, [" * " + pkg], parent)
@@ -169,7 +177,7 @@ def main(argv):
 
     try:
         with Seed(options.seeds, options.release, "blacklist",
-                  options.vcs) as blacklist:
+                  options.vcs, cache_dir=seed_cache_dir) as blacklist:
             g.parse_blacklist(structure, blacklist)
     except SeedError:
         pass
@@ -22,12 +22,13 @@
 
 import logging
 import optparse
+import os
 import subprocess
 import sys
 
 import germinate.archive
 import germinate.defaults
-from germinate.germinator import Germinator
+from germinate.germinator import ARCHIVE_FIELDS, Germinator
 from germinate.log import germinate_logging
 from germinate.seeds import SeedError, SeedStructure
 import germinate.version
@@ -38,42 +39,39 @@ COMPONENTS = ["main"]
 
 
 class Package:
+    __slots__ = ('name', 'seed', 'installed')
+
     def __init__(self, name):
         self.name = name
-        self.seed = {}
-        self.installed = 0
+        self.seed = set()
+        self.installed = False
 
     def set_seed(self, seed):
-        self.seed[seed] = 1
+        self.seed.add(seed)
 
     def set_installed(self):
-        self.installed = 1
+        self.installed = True
 
     def output(self, outmode):
-        ret = self.name.ljust(30) + "\t"
-        if outmode == "i":
-            if self.installed and not len(self.seed):
-                ret += "deinstall"
-            elif not self.installed and len(self.seed):
-                ret += "install"
-            else:
-                return ""
-        elif outmode == "r":
-            if self.installed and not len(self.seed):
-                ret += "install"
-            elif not self.installed and len(self.seed):
-                ret += "deinstall"
+        added = not self.installed and self.seed
+        removed = self.installed and not self.seed
+        if outmode == "i" or outmode == "r":
+            if added:
+                action = "install" if outmode == "i" else "deinstall"
+            elif removed:
+                action = "deinstall" if outmode == "i" else "install"
             else:
                 return ""
+            return "{0:<30}\t{1}".format(self.name, action)
         else:           # default case
-            if self.installed and not len(self.seed):
-                ret = "- " + ret
-            elif not self.installed and len(self.seed):
-                ret = "+ " + ret
+            if removed:
+                marker = "-"
+            elif added:
+                marker = "+"
             else:
-                ret = "  " + ret
-            ret += ",".join(sorted(self.seed))
-        return ret
+                marker = " "
+            return "{0} {1:<30}\t{2}".format(
+                marker, self.name, ",".join(sorted(self.seed)))
 
 
 class Globals:
@@ -83,6 +81,14 @@ class Globals:
         self.outputs = {}
         self.outmode = ""
 
+    def _get_package(self, pkg):
+        # Only construct a Package when the name is new; setdefault would
+        # build (and throw away) one on every call.
+        p = self.package.get(pkg)
+        if p is None:
+            p = self.package[pkg] = Package(pkg)
+        return p
+
     def set_seeds(self, options, seeds):
         self.seeds = seeds
 
@@ -95,13 +101,18 @@ class Globals:
         g = Germinator(options.arch)
 
         archive = germinate.archive.TagFile(
-            options.dist, COMPONENTS, options.arch, MIRRORS, cleanup=True)
+            options.dist, COMPONENTS, options.arch, MIRRORS,
+            fields=ARCHIVE_FIELDS,
+            cache_dir=germinate.archive.default_cache_dir())
         g.parse_archive(archive)
 
         needed_seeds = []
         build_tree = False
         try:
-            structure = SeedStructure(options.release, options.seeds)
+            structure = SeedStructure(
+                options.release, options.seeds,
+                cache_dir=os.path.join(
+                    germinate.archive.default_cache_dir(), 'seeds'))
             for seedname in self.seeds:
                 if seedname == ('%s+build-depends' % structure.supported):
                     seedname = structure.supported
@@ -114,14 +125,12 @@ class Globals:
 
         for seedname in structure.names:
             for pkg in g.get_seed_entries(structure, seedname):
-                self.package.setdefault(pkg, Package(pkg))
-                self.package[pkg].set_seed(seedname + ".seed")
+                self._get_package(pkg).set_seed(seedname + ".seed")
             for pkg in g.get_seed_recommends_entries(structure, seedname):
-                self.package.setdefault(pkg, Package(pkg))
-                self.package[pkg].set_seed(seedname + ".seed-recommends")
+                self._get_package(pkg).set_seed(
+                    seedname + ".seed-recommends")
             for pkg in g.get_depends(structure, seedname):
-                self.package.setdefault(pkg, Package(pkg))
-                self.package[pkg].set_seed(seedname + ".depends")
+                self._get_package(pkg).set_seed(seedname + ".depends")
 
             if build_tree:
                 build_depends = set(g.get_build_depends(structure, seedname))
@@ -131,9 +140,16 @@ class Globals:
                         structure, inner))
                     build_depends -= g.get_depends(structure, inner)
                 for pkg in build_depends:
-                    self.package.setdefault(pkg, Package(pkg))
-                    self.package[pkg].set_seed(structure.supported +
-                                               ".build-depends")
+                    self._get_package(pkg).set_seed(
+                        structure.supported + ".build-depends")
+
+    def _parse_selections(self, lines):
+        get_package = self._get_package
+        for l in lines:
+            pkg, st = l.split(None)
+            p = get_package(pkg)
+            if st == "install" or st == "hold":
+                p.set_installed()
 
     def parse_dpkg(self, fname):
         if fname is None:
@@ -141,28 +157,26 @@ class Globals:
                                         stdout=subprocess.PIPE,
                                         universal_newlines=True)
             try:
-                lines = dpkg_cmd.stdout.readlines()
+                self._parse_selections(dpkg_cmd.stdout)
             finally:
                 if dpkg_cmd.stdout:
                     dpkg_cmd.stdout.close()
                 dpkg_cmd.wait()
         else:
             with open(fname) as f:
-                lines = f.readlines()
-        for l in lines:
-            pkg, st = l.split(None)
-            self.package.setdefault(pkg, Package(pkg))
-            if st == "install" or st == "hold":
-                self.package[pkg].set_installed()
+                self._parse_selections(f)
 
     def set_output(self, mode):
         self.outmode = mode
 
     def output(self):
-        for k in sorted(self.package):
-            l = self.package[k].output(self.outmode)
-            if len(l):
-                print(l)
+        lines = []
+        for _, pkg in sorted(self.package.items()):
+            l = pkg.output(self.outmode)
+            if l:
+                lines.append(l)
+        if lines:
+            sys.stdout.write("\n".join(lines) + "\n")
 
 
 def parse_options(argv):
@@ -23,38 +23,105 @@
 # TODO:
 # - Exclude essential packages from dependencies
 
-from __future__ import print_function
-
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from configparser import ConfigParser
+import io
 import logging
+import multiprocessing
 import optparse
 import os
-import re
+import shutil
 import subprocess
 import sys
+import tempfile
+import textwrap
 
-try:
-    # >= 3.0
-    from configparser import NoOptionError, NoSectionError
-    if (sys.version_info[0] < 3 or
-        (sys.version_info[0] == 3 and sys.version_info[1] < 2)):
-        # < 3.2
-        from configparser import SafeConfigParser
-    else:
-        # >= 3.2
-        from configparser import ConfigParser as SafeConfigParser
-except ImportError:
-    # < 3.0
-    from ConfigParser import NoOptionError, NoSectionError, SafeConfigParser
+import apt_pkg
 
 import germinate.archive
-from germinate.germinator import Germinator
+import germinate.fetch
+from germinate.germinator import ARCHIVE_FIELDS, Germinator
 from germinate.log import germinate_logging
-from germinate.seeds import SeedError, SeedStructure, SeedVcs
+from germinate.seeds import AtomicFile, SeedError, SeedStructure, SeedVcs
 import germinate.version
 
 
-__pychecker__ = 'maxlocals=80'
+_logger = logging.getLogger(__name__)
+
+
+def _skipping(seed_name, architecture, package, reason):
+    # Marked as progress so that GerminateFormatter leaves out its debug
+    # indentation, as for the plain lines that these used to be.
+    _logger.debug("%s/%s: Skipping package %s (%s)",
+                  seed_name, architecture, package, reason,
+                  extra={'progress': True})
+
+
+# The current run's per-architecture worker; see _run_architecture.
+_process_architecture = None
+
+
+def _run_architecture(architecture):
+    """Run _process_architecture in a worker process.
+
+    Nested functions cannot be pickled, so this is what is submitted to the
+    process pool; the worker inherits _process_architecture when it is
+    forked.  Output, whether printed or logged, is collected and returned
+    along with the result, so that each architecture's output appears in
+    one piece.  If the architecture fails, its output is written out
+    before the exception is passed on.
+
+    """
+    # The parent may already have fetched seeds over HTTP.
+    germinate.fetch.reset_connections()
+    stdout = sys.stdout
+    output = io.StringIO()
+    # The handlers set up by germinate_logging were created before the
+    # fork, and so still write to the real stdout.
+    handlers = [
+        handler for handler in logging.getLogger('germinate').handlers
+        if isinstance(handler, logging.StreamHandler) and
+        handler.stream is stdout]
+    sys.stdout = output
+    for handler in handlers:
+        handler.setStream(output)
+    try:
+        result = _process_architecture(architecture)
+    except BaseException:
+        stdout.write(output.getvalue())
+        stdout.flush()
+        raise
+    finally:
+        sys.stdout = stdout
+        for handler in handlers:
+            handler.setStream(stdout)
+    return output.getvalue(), result
+
+
+def add_changelog_items(changes, changelog='debian/changelog'):
+    """Add items to the end of the first entry in a changelog.
+
+    This is equivalent to running 'dch -a' once for each item, but rewrites
+    the changelog only once.
+
+    """
+    with io.open(changelog, encoding='UTF-8') as f:
+        lines = f.readlines()
+    # Insert before the blank line(s) preceding the first trailer line.
+    end = 0
+    while end < len(lines) and not lines[end].startswith(' -- '):
+        end += 1
+    while end > 0 and not lines[end - 1].strip():
+        end -= 1
+    # Wrap the same way as dch does.
+    lines[end:end] = [
+        textwrap.fill(change, width=79, initial_indent='  * ',
+                      subsequent_indent='    ', break_long_words=False,
+                      break_on_hyphens=False) + '\n'
+        for change in changes]
+    with AtomicFile(changelog) as f:
+        f.writelines(lines)
 
 
 def error_exit(message):
@@ -84,6 +151,9 @@ update.cfg.'''
     parser.add_option('--bzr', dest='vcs', action='store_true',
                       help='fetch seeds using bzr (requires bzr to be '
                            'installed; use --vcs instead)')
+    parser.add_option('-v', '--verbose', dest='verbose', action='store_true',
+                      default=False,
+                      help='be more verbose when processing seeds')
     return parser.parse_args(argv[1:])
 
 
@@ -108,115 +178,144 @@ def main(argv):
 
     print("[info] Initialising %s-* package lists update..." % metapackage)
 
-    config = SafeConfigParser()
+    config = ConfigParser()
     with open('update.cfg') as config_file:
-        try:
-            # >= 3.2
-            config.read_file(config_file)
-        except AttributeError:
-            # < 3.2
-            config.readfp(config_file)
+        config.read_file(config_file)
 
     if len(args) > 0:
         dist = args[0]
     else:
         dist = config.get('DEFAULT', 'dist')
 
-    seeds = config.get(dist, 'seeds').split()
-    try:
-        output_seeds = config.get(dist, 'output_seeds').split()
-    except NoOptionError:
+    # Snapshot the relevant sections once, rather than going through
+    # ConfigParser's lookup and interpolation machinery for every option.
+    def section_options(section):
+        if config.has_section(section):
+            return dict(config.items(section))
+        else:
+            return {}
+
+    dist_opts = dict(config.items(dist))
+    vcs_opts = section_options("%s/vcs" % dist)
+    # Backward compatibility.
+    bzr_opts = section_options("%s/bzr" % dist)
+
+    seeds = dist_opts['seeds'].split()
+    if 'output_seeds' in dist_opts:
+        output_seeds = dist_opts['output_seeds'].split()
+    else:
         output_seeds = list(seeds)
-    architectures = config.get(dist, 'architectures').split()
-    try:
-        archive_base_default = config.get(dist, 'archive_base/default')
-        archive_base_default = re.split(r'[, ]+', archive_base_default)
-    except (NoSectionError, NoOptionError):
+    architectures = dist_opts['architectures'].split()
+    if 'archive_base/default' in dist_opts:
+        archive_base_default = (
+            dist_opts['archive_base/default'].replace(',', ' ').split())
+    else:
         archive_base_default = None
 
     archive_base = {}
     for arch in architectures:
-        try:
-            archive_base[arch] = config.get(dist, 'archive_base/%s' % arch)
-            archive_base[arch] = re.split(r'[, ]+', archive_base[arch])
-        except (NoSectionError, NoOptionError):
-            if archive_base_default is not None:
-                archive_base[arch] = archive_base_default
-            else:
-                error_exit('no archive_base configured for %s' % arch)
+        if 'archive_base/%s' % arch in dist_opts:
+            archive_base[arch] = (
+                dist_opts['archive_base/%s' % arch].replace(',', ' ').split())
+        elif archive_base_default is not None:
+            archive_base[arch] = archive_base_default
+        else:
+            error_exit('no archive_base configured for %s' % arch)
 
-    if options.vcs and config.has_option("%s/vcs" % dist, 'seed_base'):
-        seed_base = config.get("%s/vcs" % dist, 'seed_base')
-    elif options.vcs and config.has_option("%s/bzr" % dist, 'seed_base'):
-        # Backward compatibility.
-        seed_base = config.get("%s/bzr" % dist, 'seed_base')
+    if options.vcs and 'seed_base' in vcs_opts:
+        seed_base = vcs_opts['seed_base']
+    elif options.vcs and 'seed_base' in bzr_opts:
+        seed_base = bzr_opts['seed_base']
     else:
-        seed_base = config.get(dist, 'seed_base')
-    seed_base = re.split(r'[, ]+', seed_base)
-    if options.vcs and config.has_option("%s/vcs" % dist, 'seed_dist'):
-        seed_dist = config.get("%s/vcs" % dist, 'seed_dist')
-    elif options.vcs and config.has_option("%s/bzr" % dist, 'seed_dist'):
-        # Backward compatibility.
-        seed_dist = config.get("%s/bzr" % dist, 'seed_dist')
-    elif config.has_option(dist, 'seed_dist'):
-        seed_dist = config.get(dist, 'seed_dist')
+        seed_base = dist_opts['seed_base']
+    seed_base = seed_base.replace(',', ' ').split()
+    if options.vcs and 'seed_dist' in vcs_opts:
+        seed_dist = vcs_opts['seed_dist']
+    elif options.vcs and 'seed_dist' in bzr_opts:
+        seed_dist = bzr_opts['seed_dist']
     else:
-        seed_dist = dist
-    if config.has_option(dist, 'dists'):
-        dists = config.get(dist, 'dists').split()
+        seed_dist = dist_opts.get('seed_dist', dist)
+    if 'dists' in dist_opts:
+        dists = dist_opts['dists'].split()
     else:
         dists = [dist]
-    try:
-        archive_exceptions = config.get(dist, 'archive_base/exceptions').split()
-    except (NoSectionError, NoOptionError):
-        archive_exceptions = []
-
-    components = config.get(dist, 'components').split()
-
-    def seed_packages(germinator_method, structure, seed_name):
-        if config.has_option(dist, "seed_map/%s" % seed_name):
-            mapped_seeds = config.get(dist, "seed_map/%s" % seed_name).split()
-        else:
-            mapped_seeds = []
-            task_seeds_re = re.compile('^Task-Seeds:\s*(.*)', re.I)
-            with structure[seed_name] as seed:
-                for line in seed:
-                    task_seeds_match = task_seeds_re.match(line)
-                    if task_seeds_match is not None:
-                        mapped_seeds = task_seeds_match.group(1).split()
-                        break
+    archive_exceptions = dist_opts.get('archive_base/exceptions', '').split()
+
+    components = dist_opts['components'].split()
+
+    # Per-seed overrides, keyed by seed name as transformed by ConfigParser
+    # (i.e. lower-cased).
+    seed_map = {}
+    metapackage_map_cfg = {}
+    for key, value in dist_opts.items():
+        if key.startswith('seed_map/'):
+            seed_map[key[len('seed_map/'):]] = value.split()
+        elif key.startswith('metapackage_map/'):
+            metapackage_map_cfg[key[len('metapackage_map/'):]] = value
+
+    def seed_mappings(structure, seed_name):
+        """Return the seeds making up a seed's list, and its metapackage.
+
+        Configuration in update.cfg takes precedence over the seed's
+        Task-Seeds and Task-Metapackage headers; both headers are found in
+        a single pass over the seed.
+
+        """
+        option_name = config.optionxform(seed_name)
+        mapped_seeds = seed_map.get(option_name)
+        meta_name = metapackage_map_cfg.get(option_name)
+        if mapped_seeds is not None and meta_name is not None:
+            return mapped_seeds, meta_name
+
+        task_seeds = None
+        task_meta = None
+        with structure[seed_name] as seed:
+            for line in seed:
+                # These are fixed, case-insensitive prefixes; a regex is
+                # overkill when run over every line.
+                if task_seeds is None and line[:11].lower() == 'task-seeds:':
+                    task_seeds = line[11:].split()
+                elif (task_meta is None and
+                      line[:17].lower() == 'task-metapackage:'):
+                    task_meta = line[17:].strip()
+                if task_seeds is not None and task_meta is not None:
+                    break
+
+        if mapped_seeds is None:
+            mapped_seeds = task_seeds or []
             if seed_name not in mapped_seeds:
                 mapped_seeds.append(seed_name)
+        if meta_name is None:
+            if task_meta is not None:
+                meta_name = task_meta
+            else:
+                meta_name = "%s-%s" % (metapackage, seed_name)
+        return mapped_seeds, meta_name
+
+    def seed_packages(germinator_method, structure, seed_name):
         packages = []
-        for mapped_seed in mapped_seeds:
+        for mapped_seed in mapped_seeds[seed_name]:
             packages.extend(germinator_method(structure, mapped_seed))
         return packages
 
-    def metapackage_name(structure, seed_name):
-        if config.has_option(dist, "metapackage_map/%s" % seed_name):
-            return config.get(dist, "metapackage_map/%s" % seed_name)
-        else:
-            task_meta_re = re.compile('^Task-Metapackage:\s*(.*)', re.I)
-            with structure[seed_name] as seed:
-                for line in seed:
-                    task_meta_match = task_meta_re.match(line)
-                    if task_meta_match is not None:
-                        return task_meta_match.group(1)
-            return "%s-%s" % (metapackage, seed_name)
-
     debootstrap_version_file = 'debootstrap-version'
 
     def get_debootstrap_version():
-        version_cmd = subprocess.Popen(
-            ['dpkg-query', '-W', '--showformat', '${Version}', 'debootstrap'],
-            stdout=subprocess.PIPE, universal_newlines=True)
-        version, _ = version_cmd.communicate()
+        # Read the dpkg database directly rather than running dpkg-query.
+        version = None
+        status = apt_pkg.config.find_file('Dir::State::status')
+        with apt_pkg.TagFile(status) as tag_file:
+            for section in tag_file:
+                if section.get('Package') == 'debootstrap':
+                    if section.get('Status', '').endswith(' installed'):
+                        version = section.get('Version')
+                    break
         if not version:
             error_exit('debootstrap does not appear to be installed')
 
         return version
 
-    def debootstrap_packages(arch):
+    def start_debootstrap(arch, target):
         env = dict(os.environ)
         if 'PATH' in env:
             env['PATH'] = '/usr/sbin:/sbin:%s' % env['PATH']
@@ -225,9 +324,12 @@ def main(argv):
         debootstrap = subprocess.Popen(
             ['debootstrap', '--arch', arch,
              '--components', ','.join(components),
-             '--print-debs', dist, 'debootstrap-dir', archive_base[arch][0]],
+             '--print-debs', dist, target, archive_base[arch][0]],
             stdout=subprocess.PIPE, env=env, stderr=subprocess.PIPE,
             universal_newlines=True)
+        return debootstrap
+
+    def debootstrap_packages(debootstrap):
         (debootstrap_stdout, debootstrap_stderr) = debootstrap.communicate()
         if debootstrap.returncode != 0:
             error_exit('Unable to retrieve package list from debootstrap; '
@@ -244,10 +346,8 @@ def main(argv):
             with open(debootstrap_version_file) as debootstrap:
                 old_debootstrap_version = debootstrap.read().strip()
             debootstrap_version = get_debootstrap_version()
-            failed = subprocess.call(
-                ['dpkg', '--compare-versions',
-                 debootstrap_version, 'ge', old_debootstrap_version])
-            if failed:
+            if apt_pkg.version_compare(
+                    debootstrap_version, old_debootstrap_version) < 0:
                 error_exit('Installed debootstrap is older than in the '
                            'previous version! (%s < %s)' %
                            (debootstrap_version, old_debootstrap_version))
@@ -261,10 +361,11 @@ def main(argv):
         for pkg, arch in items:
             by_arch[pkg].add(arch)
         all_pkgs = sorted(by_arch)
+        all_arches = set(architectures)
         chunks = []
         for pkg in all_pkgs:
             arches = by_arch[pkg]
-            if set(architectures) - arches:
+            if all_arches - arches:
                 # only some architectures
                 chunks.append('%s [%s]' % (pkg, ' '.join(sorted(arches))))
             else:
@@ -272,27 +373,58 @@ def main(argv):
                 chunks.append(pkg)
         return ', '.join(chunks)
 
-    germinate_logging(logging.DEBUG)
+    if options.verbose:
+        germinate_logging(logging.DEBUG)
+    else:
+        germinate_logging(logging.INFO)
 
     check_debootstrap_version()
 
-    additions = defaultdict(list)
-    removals = defaultdict(list)
-    moves = defaultdict(list)
+    # The seeds are the same for every architecture, so fetch them and work
+    # out how they map to metapackages only once.
+    print("[info] Loading seed lists...")
+    try:
+        structure = SeedStructure(
+            seed_dist, seed_base, options.vcs,
+            cache_dir=os.path.join(
+                germinate.archive.default_cache_dir(), 'seeds'))
+    except SeedError:
+        sys.exit(1)
+    mapped_seeds = {}
     metapackage_map = {}
-    for architecture in architectures:
-        print("[%s] Downloading available package lists..." % architecture)
-        germinator = Germinator(architecture)
-        archive = germinate.archive.TagFile(
-            dists, components, architecture,
-            archive_base[architecture], source_mirrors=archive_base_default,
-            cleanup=True, archive_exceptions=archive_exceptions)
-        germinator.parse_archive(archive)
-        debootstrap_base = set(debootstrap_packages(architecture))
-
-        print("[%s] Loading seed lists..." % architecture)
+    for seed_name in output_seeds:
+        mapped_seeds[seed_name], metapackage_map[seed_name] = (
+            seed_mappings(structure, seed_name))
+
+    def process_architecture(architecture):
+        additions = defaultdict(set)
+        removals = defaultdict(set)
+        moves = defaultdict(set)
+
+        # Let debootstrap work out its package list while we fetch and
+        # parse the archive.  Architectures are processed concurrently, so
+        # each needs its own debootstrap target directory.
+        debootstrap_dir = tempfile.mkdtemp(
+            prefix='debootstrap-%s-' % architecture)
+        try:
+            debootstrap = start_debootstrap(architecture, debootstrap_dir)
+
+            print("[%s] Downloading available package lists..." %
+                  architecture)
+            germinator = Germinator(architecture)
+            archive = germinate.archive.TagFile(
+                dists, components, architecture,
+                archive_base[architecture],
+                source_mirrors=archive_base_default,
+                archive_exceptions=archive_exceptions, fields=ARCHIVE_FIELDS,
+                cache_dir=cache_dir)
+            germinator.parse_archive(archive)
+            debootstrap_base = set(debootstrap_packages(debootstrap))
+        finally:
+            shutil.rmtree(debootstrap_dir, ignore_errors=True)
+
+        print("[%s] Planting seeds..." % architecture)
         try:
-            structure = SeedStructure(seed_dist, seed_base, options.vcs)
             germinator.plant_seeds(structure, seeds=seeds)
         except SeedError:
             sys.exit(1)
@@ -300,16 +432,17 @@ def main(argv):
         print("[%s] Merging seeds with available package lists..." %
               architecture)
         for seed_name in output_seeds:
-            meta_name = metapackage_name(structure, seed_name)
-            metapackage_map[seed_name] = meta_name
+            meta_name = metapackage_map[seed_name]
 
             output_filename = os.path.join(
                 options.outdir, '%s-%s' % (seed_name, architecture))
             old_list = None
-            if os.path.exists(output_filename):
+            try:
                 with open(output_filename) as output:
-                    old_list = set(map(str.strip, output.readlines()))
-                os.rename(output_filename, output_filename + '.old')
+                    old_list = {line.strip() for line in output}
+                os.replace(output_filename, output_filename + '.old')
+            except FileNotFoundError:
+                pass
 
             # work on the depends
             new_list = []
@@ -317,23 +450,20 @@ def main(argv):
                                      structure, seed_name)
             for package in packages:
                 if package == meta_name:
-                    print("%s/%s: Skipping package %s (metapackage)" %
-                          (seed_name, architecture, package))
+                    _skipping(seed_name, architecture, package, 'metapackage')
                 elif (seed_name == 'minimal' and
                       package not in debootstrap_base):
-                    print("%s/%s: Skipping package %s (package not in "
-                          "debootstrap)" % (seed_name, architecture, package))
+                    _skipping(seed_name, architecture, package,
+                              'package not in debootstrap')
                 elif germinator.is_essential(package):
-                    print("%s/%s: Skipping package %s (essential)" %
-                          (seed_name, architecture, package))
+                    _skipping(seed_name, architecture, package, 'essential')
                 else:
                     new_list.append(package)
 
             new_list.sort()
             with open(output_filename, 'w') as output:
-                for package in new_list:
-                    output.write(package)
-                    output.write('\n')
+                if new_list:
+                    output.write('\n'.join(new_list) + '\n')
 
             # work on the recommends
             old_recommends_list = None
@@ -342,12 +472,11 @@ def main(argv):
                                      structure, seed_name)
             for package in packages:
                 if package == meta_name:
-                    print("%s/%s: Skipping package %s (metapackage)" %
-                          (seed_name, architecture, package))
+                    _skipping(seed_name, architecture, package, 'metapackage')
                     continue
                 if seed_name == 'minimal' and package not in debootstrap_base:
-                    print("%s/%s: Skipping package %s (package not in "
-                          "debootstrap)" % (seed_name, architecture, package))
+                    _skipping(seed_name, architecture, package,
+                              'package not in debootstrap')
                 else:
                     new_recommends_list.append(package)
 
@@ -355,59 +484,94 @@ def main(argv):
             seed_name_recommends = '%s-recommends' % seed_name
             output_recommends_filename = os.path.join(
                 options.outdir, '%s-%s' % (seed_name_recommends, architecture))
-            if os.path.exists(output_recommends_filename):
+            try:
                 with open(output_recommends_filename) as output:
-                    old_recommends_list = set(
-                        map(str.strip, output.readlines()))
-                os.rename(
+                    old_recommends_list = {line.strip() for line in output}
+                os.replace(
                     output_recommends_filename,
                     output_recommends_filename + '.old')
+            except FileNotFoundError:
+                pass
 
             with open(output_recommends_filename, 'w') as output:
-                for package in new_recommends_list:
-                    output.write(package)
-                    output.write('\n')
+                if new_recommends_list:
+                    output.write('\n'.join(new_recommends_list) + '\n')
 
             # Calculate deltas
-            merged = defaultdict(int)
-            recommends_merged = defaultdict(int)
+            added = removed = frozenset()
+            recommends_added = recommends_removed = frozenset()
             if old_list is not None:
-                for package in new_list:
-                    merged[package] += 1
-                for package in old_list:
-                    merged[package] -= 1
+                new_set = set(new_list)
+                added = new_set - old_list
+                removed = old_list - new_set
             if old_recommends_list is not None:
-                for package in new_recommends_list:
-                    recommends_merged[package] += 1
-                for package in old_recommends_list:
-                    recommends_merged[package] -= 1
-
-            mergeditems = sorted(merged.items())
-            for package, value in mergeditems:
-                #print(package, value)
-                if value == 1:
-                    if recommends_merged.get(package, 0) == -1:
-                        moves[package].append([seed_name, architecture])
-                        recommends_merged[package] += 1
-                    else:
-                        additions[package].append([seed_name, architecture])
-                elif value == -1:
-                    if recommends_merged.get(package, 0) == 1:
-                        moves[package].append([seed_name_recommends,
-                                               architecture])
-                        recommends_merged[package] -= 1
-                    else:
-                        removals[package].append([seed_name, architecture])
-
-            mergedrecitems = sorted(recommends_merged.items())
-            for package, value in mergedrecitems:
-                #print(package, value)
-                if value == 1:
-                    additions[package].append([seed_name_recommends,
-                                               architecture])
-                elif value == -1:
-                    removals[package].append([seed_name_recommends,
-                                              architecture])
+                new_recommends_set = set(new_recommends_list)
+                recommends_added = new_recommends_set - old_recommends_list
+                recommends_removed = old_recommends_list - new_recommends_set
+            # Packages that moved between depends and recommends.
+            moved_up = added & recommends_removed
+            moved_down = removed & recommends_added
+
+            for package in added:
+                if package in moved_up:
+                    moves[package].add((seed_name, architecture))
+                else:
+                    additions[package].add((seed_name, architecture))
+            for package in removed:
+                if package in moved_down:
+                    moves[package].add((seed_name_recommends, architecture))
+                else:
+                    removals[package].add((seed_name, architecture))
+            for package in recommends_added - moved_down:
+                additions[package].add((seed_name_recommends, architecture))
+            for package in recommends_removed - moved_up:
+                removals[package].add((seed_name_recommends, architecture))
+
+        return additions, removals, moves
+
+    # Architectures are independent of each other, and each one is
+    # dominated by downloading and parsing its archive, so process several
+    # at once.  Each holds a whole archive's worth of package data, so
+    # run no more of them than there are CPUs.  Worker processes are
+    # forked so that they inherit the seeds and configuration loaded above.
+    global _process_architecture
+    _process_architecture = process_architecture
+    additions = defaultdict(set)
+    removals = defaultdict(set)
+    moves = defaultdict(set)
+    # Anything still buffered would otherwise be flushed again by each
+    # worker as it exits.
+    sys.stdout.flush()
+    # Share downloaded index files between architectures, so that files
+    # they have in common (such as Sources) are only fetched once.
+    cache_dir = tempfile.mkdtemp(prefix='germinate-')
+    try:
+        with ProcessPoolExecutor(
+                max_workers=min(len(architectures), os.cpu_count() or 1),
+                mp_context=multiprocessing.get_context('fork')) as executor:
+            futures = [executor.submit(_run_architecture, architecture)
+                       for architecture in architectures]
+            # Collect every architecture's output even if one fails; a
+            # failed worker writes out its own output.
+            failures = []
+            for future in futures:
+                try:
+                    output, (arch_additions, arch_removals, arch_moves) = (
+                        future.result())
+                except (Exception, SystemExit) as e:
+                    failures.append(e)
+                    continue
+                sys.stdout.write(output)
+                for package, items in arch_additions.items():
+                    additions[package].update(items)
+                for package, items in arch_removals.items():
+                    removals[package].update(items)
+                for package, items in arch_moves.items():
+                    moves[package].update(items)
+            if failures:
+                raise failures[0]
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
 
     with open('metapackage-map', 'w') as metapackage_map_file:
         for seed_name in output_seeds:
@@ -415,18 +579,7 @@ def main(argv):
                   file=metapackage_map_file)
 
     if not options.nodch and (additions or removals or moves):
-        dch_help = subprocess.Popen(['dch', '--help'], stdout=subprocess.PIPE,
-                                    universal_newlines=True)
-        try:
-            have_U = '-U' in dch_help.stdout.read()
-        finally:
-            if dch_help.stdout:
-                dch_help.stdout.close()
-            dch_help.wait()
-        if have_U:
-            subprocess.check_call(['dch', '-iU', 'Refreshed dependencies'])
-        else:
-            subprocess.check_call(['dch', '-i', 'Refreshed dependencies'])
+        subprocess.check_call(['dch', '-iU', 'Refreshed dependencies'])
         changes = []
         for package in sorted(additions):
             changes.append('Added %s to %s' %
@@ -443,7 +596,7 @@ def main(argv):
                            (package, format_changes(moves[package])))
         for change in changes:
             print(change)
-            subprocess.check_call(['dch', '-a', change])
+        add_changelog_items(changes)
         update_debootstrap_version()
     else:
         if not options.nodch:
@@ -18,12 +18,14 @@
 # Software Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
 # 02110-1301, USA.
 
-from __future__ import print_function
-
 import atexit
-import codecs
 import collections
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import hashlib
 import io
+import itertools
 import logging
 import os
 import re
@@ -31,21 +33,22 @@ import shutil
 import subprocess
 import sys
 import tempfile
-try:
-    from urllib.parse import urljoin, urlparse as _urlparse
-    from urllib.request import Request, URLError, urlopen
-except ImportError:
-    from urlparse import urljoin, urlparse as _urlparse
-    from urllib2 import Request, URLError, urlopen
+import threading
+from urllib.error import HTTPError, URLError
+from urllib.parse import quote, urljoin, urlparse as _urlparse
+from urllib.request import Request, url2pathname, urlopen
 
 import germinate.defaults
+from germinate.fetch import (
+    FETCH_WORKERS,
+    NotModified,
+    add_validators,
+    download,
+    locked,
+    )
 from germinate.tsort import topo_sort
 
 
-# pychecker gets confused by __next__ for Python 3 support.
-__pychecker__ = 'no-special'
-
-
 __all__ = [
     'Seed',
     'SeedError',
@@ -58,40 +61,127 @@ _logger = logging.getLogger(__name__)
 
 
 _vcs_cache_dir = None
+_vcs_cache_dir_lock = threading.Lock()
+
+
+def _get_vcs_cache_dir():
+    """Return the directory holding this process's VCS checkouts."""
+    global _vcs_cache_dir
+    # Seed branches may be checked out from several threads at once.
+    with _vcs_cache_dir_lock:
+        if _vcs_cache_dir is None:
+            _vcs_cache_dir = tempfile.mkdtemp(prefix='germinate-')
+            atexit.register(
+                shutil.rmtree, _vcs_cache_dir, ignore_errors=True)
+    return _vcs_cache_dir
+
+
+# Matches the host name in an ssh URL for a bzr or git branch.
+_ssh_host = re.compile(r'(?:bzr|git)\+ssh://(?:[^/]*?@)?(.*?)(?:/|$)')
+
+
+def _join_dir(base, branch):
+    """Join base and branch, returning a path ending in a slash."""
+    path = os.path.join(base, branch)
+    if not path.endswith('/'):
+        path += '/'
+    return path
 
 
-if sys.version >= '3':
-    _string_types = str
-    _text_type = str
-else:
-    _string_types = basestring
-    _text_type = unicode
+_checkout_locks = {}
+
+# Checkouts that have been created or brought up to date by this process.
+_fresh_checkouts = set()
+
+
+def _checkout_lock(checkout):
+    """Return a lock serialising work on one VCS checkout."""
+    with _vcs_cache_dir_lock:
+        return _checkout_locks.setdefault(checkout, threading.Lock())
+
+
+def _git_raw_url(base, repository, git_branch, name):
+    """Return a URL serving one file from a git branch, or None.
+
+    Some git hosts can serve individual files over plain HTTP, which is
+    much cheaper than cloning a whole repository to read a few seeds.
+    """
+    parsed = _urlparse(base)
+    if parsed.scheme not in ('git', 'http', 'https'):
+        return None
+    path = '/'.join([parsed.path.strip('/'), repository]).strip('/')
+    if parsed.hostname == 'git.launchpad.net':
+        url = 'https://git.launchpad.net/%s/plain/%s' % (path, quote(name))
+        if git_branch is not None:
+            url += '?h=%s' % quote(git_branch, safe='')
+        return url
+    elif parsed.hostname == 'github.com':
+        if path.endswith('.git'):
+            path = path[:-4]
+        return 'https://raw.githubusercontent.com/%s/%s/%s' % (
+            path, quote(git_branch or 'HEAD', safe=''), quote(name))
+    else:
+        return None
+
+
+# Output files such as germinator reports can run to hundreds of
+# kilobytes, written a line at a time; buffer them generously.
+_WRITE_BUFSIZE = 1024 * 1024
 
 
 class AtomicFile(object):
-    """Facilitate atomic writing of files.  Forces UTF-8 encoding."""
+    """Facilitate atomic writing of files.  Forces UTF-8 encoding.
+
+    Where the system supports it, the new contents are written to an
+    unnamed temporary file, which only gets a name once it is complete;
+    so nothing is left behind if writing fails part-way through.
+    """
 
     def __init__(self, filename):
         self.filename = filename
-        if sys.version_info[0] < 3:
-            self.fd = codecs.open(
-                '%s.new' % self.filename, 'w', 'UTF-8', 'replace')
-        else:
-            # io.open is available from Python 2.6, but we only use it with
-            # Python 3 because it raises exceptions when passed bytes.
-            self.fd = io.open(
-                '%s.new' % self.filename, mode='w',
-                encoding='UTF-8', errors='replace')
+        self._anonymous = False
+        if hasattr(os, 'O_TMPFILE') and os.path.isdir('/proc/self/fd'):
+            try:
+                fd = os.open(
+                    os.path.dirname(filename) or '.',
+                    os.O_TMPFILE | os.O_WRONLY, 0o666)
+                self._anonymous = True
+            except OSError:
+                # Not supported by this filesystem.
+                pass
+        if not self._anonymous:
+            fd = '%s.new' % self.filename
+        self.fd = open(
+            fd, mode='w', buffering=_WRITE_BUFSIZE,
+            encoding='UTF-8', errors='replace')
 
     def __enter__(self):
         return self.fd
 
     def __exit__(self, exc_type, unused_exc_value, unused_exc_tb):
-        self.fd.close()
+        new = '%s.new' % self.filename
+        try:
+            if exc_type is None and self._anonymous:
+                self.fd.flush()
+                # An unnamed file cannot be linked over an existing one,
+                # so give it a temporary name first.
+                try:
+                    os.unlink(new)
+                except OSError:
+                    pass
+                # Passing a directory fd makes os.link use linkat with
+                # AT_SYMLINK_FOLLOW, which is how to name an O_TMPFILE
+                # file (see open(2)).
+                proc_fd = os.open('/proc/self/fd', os.O_RDONLY)
+                try:
+                    os.link(str(self.fd.fileno()), new, src_dir_fd=proc_fd)
+                finally:
+                    os.close(proc_fd)
+        finally:
+            self.fd.close()
         if exc_type is None:
-            os.rename('%s.new' % self.filename, self.filename)
+            os.replace(new, self.filename)
 
-    # Not really necessary, but reduces pychecker confusion.
     def write(self, s):
         self.fd.write(s)
 
@@ -103,10 +193,10 @@ class SeedError(RuntimeError):
 
 
 def _ensure_unicode(s):
-    if isinstance(s, _text_type):
+    if isinstance(s, str):
         return s
     else:
-        return _text_type(s, "utf8", "replace")
+        return str(s, "utf8", "replace")
 
 
 class SeedVcs(object):
@@ -125,80 +215,207 @@ class SeedVcs(object):
 class Seed(object):
     """A single seed from a collection."""
 
+    def _checkout_dir(self, kind, base, branch):
+        """Return the directory for a VCS checkout of base/branch.
+
+        With a cache directory, checkouts are kept from one run to the next
+        and brought up to date when first used; otherwise they go in a
+        temporary directory that is removed on exit.
+        """
+        if self._cache_dir is None:
+            return os.path.join(_get_vcs_cache_dir(), branch)
+        return os.path.join(
+            self._cache_dir, kind, quote(base, safe=''), branch)
+
+    def _prepare_checkout(self, checkout, create, update):
+        """Make sure that checkout exists and is up to date.
+
+        This is done at most once per checkout in each process.
+        """
+        # Once a checkout is fresh, reading each further seed from it costs
+        # neither a lock nor a stat.
+        if checkout in _fresh_checkouts:
+            return
+        with _checkout_lock(checkout):
+            if checkout in _fresh_checkouts:
+                return
+            parent = os.path.dirname(checkout)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            # Other processes may share a persistent checkout.
+            with locked(checkout):
+                if os.path.isdir(checkout):
+                    try:
+                        update()
+                    except SeedError:
+                        _logger.warning(
+                            "Could not update %s; checking it out again",
+                            checkout)
+                        shutil.rmtree(checkout, ignore_errors=True)
+                        create()
+                else:
+                    create()
+            _fresh_checkouts.add(checkout)
+
+    def _run_vcs(self, command):
+        status = subprocess.call(command)
+        if status != 0:
+            raise SeedError("Command failed with exit status %d:\n"
+                            "  '%s'" % (status, ' '.join(command)))
+
     def _open_seed_bzr(self, base, branch, name):
-        global _vcs_cache_dir
-        if _vcs_cache_dir is None:
-            _vcs_cache_dir = tempfile.mkdtemp(prefix='germinate-')
-            atexit.register(
-                shutil.rmtree, _vcs_cache_dir, ignore_errors=True)
-        checkout = os.path.join(_vcs_cache_dir, branch)
-        if not os.path.isdir(checkout):
-            path = os.path.join(base, branch)
-            if not path.endswith('/'):
-                path += '/'
-            command = ['bzr']
-            # https://bugs.launchpad.net/bzr/+bug/39542
-            if path.startswith('http:'):
-                command.append('branch')
+        checkout = self._checkout_dir('bzr', base, branch)
+        path = _join_dir(base, branch)
+        # https://bugs.launchpad.net/bzr/+bug/39542
+        lightweight = not path.startswith('http:')
+
+        def create():
+            if lightweight:
+                _logger.info("Checking out %s", path)
+                self._run_vcs(
+                    ['bzr', 'checkout', '--lightweight', path, checkout])
+            else:
                 _logger.info("Fetching branch of %s", path)
+                self._run_vcs(['bzr', 'branch', path, checkout])
+
+        def update():
+            _logger.info("Updating checkout of %s", path)
+            if lightweight:
+                self._run_vcs(['bzr', 'update', checkout])
             else:
-                command.extend(['checkout', '--lightweight'])
-                _logger.info("Checking out %s", path)
-            command.extend([path, checkout])
-            status = subprocess.call(command)
-            if status != 0:
-                raise SeedError("Command failed with exit status %d:\n"
-                                "  '%s'" % (status, ' '.join(command)))
+                self._run_vcs(
+                    ['bzr', 'pull', '--overwrite', '-d', checkout, path])
+
+        self._prepare_checkout(checkout, create, update)
         return open(os.path.join(checkout, name))
 
+    def _run_git(self, command, shallow, cleanup=None):
+        """Run a git command, dropping the shallow options if need be.
+
+        If given, cleanup is called before retrying without them.
+        """
+        proc = subprocess.Popen(
+            command, stderr=subprocess.PIPE, universal_newlines=True)
+        _, errors = proc.communicate()
+        sys.stderr.write(errors)
+        if proc.returncode != 0 and 'shallow' in errors:
+            # Some servers (e.g. dumb HTTP) can't do shallow fetches.
+            if cleanup is not None:
+                cleanup()
+            self._run_vcs([arg for arg in command if arg not in shallow])
+        elif proc.returncode != 0:
+            raise SeedError("Command failed with exit status %d:\n"
+                            "  '%s'" % (proc.returncode, ' '.join(command)))
+
     def _open_seed_git(self, base, branch, name):
-        global _vcs_cache_dir
-        if _vcs_cache_dir is None:
-            _vcs_cache_dir = tempfile.mkdtemp(prefix='germinate-')
-            atexit.register(
-                shutil.rmtree, _vcs_cache_dir, ignore_errors=True)
-        checkout = os.path.join(_vcs_cache_dir, branch)
-        if not os.path.isdir(checkout):
-            # This is a very strange way to specify a git branch, but it's
-            # hard to do better here without breaking backward-compatibility
-            # in at least some of Germinate's own command-line arguments,
-            # the public Python API, or "include" lines in seed STRUCTURE
-            # files.
-            if '.' in branch:
-                repository, git_branch = branch.rsplit('.', 1)
-            else:
-                repository = branch
-                git_branch = None
-            path = os.path.join(base, repository)
-            if not path.endswith('/'):
-                path += '/'
-            command = ['git', 'clone']
+        # This is a very strange way to specify a git branch, but it's hard
+        # to do better here without breaking backward-compatibility in at
+        # least some of Germinate's own command-line arguments, the public
+        # Python API, or "include" lines in seed STRUCTURE files.
+        if '.' in branch:
+            repository, git_branch = branch.rsplit('.', 1)
+        else:
+            repository = branch
+            git_branch = None
+        checkout = self._checkout_dir('git', base, branch)
+        if checkout not in _fresh_checkouts:
+            url = _git_raw_url(base, repository, git_branch, name)
+            if url is not None:
+                try:
+                    return self._open_url(url)
+                except HTTPError as e:
+                    # The host answered authoritatively; anything other
+                    # than "not found" means we should fall back to
+                    # cloning.  "Not found" is a SeedError like a failed
+                    # clone, so that SeedVcs.AUTO goes on to try bzr.
+                    if e.code == 404:
+                        raise SeedError("%s not found" % url) from e
+                    _logger.info("Fetching %s failed (%s); cloning instead",
+                                 url, e)
+                except (OSError, IOError, URLError) as e:
+                    _logger.info("Fetching %s failed (%s); cloning instead",
+                                 url, e)
+
+        path = _join_dir(base, repository)
+        # We only need the files at the tip of one branch, so don't fetch
+        # history or tags.
+        shallow = ['--depth=1', '--no-tags']
+
+        def create():
+            command = ['git', 'clone'] + shallow
             if git_branch is not None:
                 command.extend(['-b', git_branch])
                 _logger.info("Cloning branch %s of %s", git_branch, path)
             else:
                 _logger.info("Cloning %s", path)
             command.extend([path, checkout])
-            status = subprocess.call(command)
-            if status != 0:
-                raise SeedError("Command failed with exit status %d:\n"
-                                "  '%s'" % (status, ' '.join(command)))
+            self._run_git(
+                command, shallow,
+                cleanup=lambda: shutil.rmtree(checkout, ignore_errors=True))
+
+        def update():
+            # Without this, git would look for a repository in the parent
+            # directories.
+            if not os.path.isdir(os.path.join(checkout, '.git')):
+                raise SeedError("%s is not a git checkout" % checkout)
+            _logger.info("Updating checkout of %s", path)
+            # Fetch from path rather than trusting the checkout's idea of
+            # its origin.
+            self._run_git(
+                ['git', '-C', checkout, 'fetch'] + shallow +
+                [path, git_branch or 'HEAD'], shallow)
+            self._run_vcs(
+                ['git', '-C', checkout, 'reset', '--quiet', '--hard',
+                 'FETCH_HEAD'])
+
+        self._prepare_checkout(checkout, create, update)
         return open(os.path.join(checkout, name))
 
+    def _open_url(self, url):
+        req = Request(url)
+        req.add_header('Cache-Control', 'no-cache')
+        req.add_header('Pragma', 'no-cache')
+        if self._cache_dir is None or req.type not in ('http', 'https'):
+            _logger.info("Downloading %s", url)
+            return urlopen(req)
+
+        # Keep a copy of each seed we download, and only fetch it again if
+        # the server says that it has changed.
+        path = os.path.join(
+            self._cache_dir, hashlib.sha1(url.encode('UTF-8')).hexdigest())
+        with locked(path):
+            if os.path.exists(path) and add_validators(req, path):
+                try:
+                    download(req, path)
+                    _logger.info("Downloaded updated %s", url)
+                except NotModified:
+                    _logger.info("Using cached %s", url)
+                except HTTPError:
+                    # The server answered, so believe it.
+                    raise
+                except (IOError, OSError, URLError):
+                    _logger.warning("Could not check whether %s is up to "
+                                    "date; using cached copy", url)
+            else:
+                _logger.info("Downloading %s", url)
+                download(req, path)
+        return open(path, 'rb')
+
     def _open_seed_url(self, base, branch, name):
-        path = os.path.join(base, branch)
-        if not path.endswith('/'):
-            path += '/'
+        path = _join_dir(base, branch)
         url = urljoin(path, name)
-        if not _urlparse(url).scheme:
+        parsed = _urlparse(url)
+        if not parsed.scheme:
             fullpath = os.path.join(path, name)
             _logger.info("Using %s", fullpath)
             return open(fullpath)
-        _logger.info("Downloading %s", url)
-        req = Request(url)
-        req.add_header('Cache-Control', 'no-cache')
-        req.add_header('Pragma', 'no-cache')
-        return urlopen(req)
+        if parsed.scheme == 'file' and parsed.netloc in ('', 'localhost'):
+            # urllib's file: handler guesses MIME types and builds HTTP-style
+            # headers for each file, none of which we need.
+            fullpath = url2pathname(parsed.path)
+            _logger.info("Using %s", fullpath)
+            return open(fullpath, 'rb')
+        return self._open_url(url)
 
     def _open_seed(self, base, branch, name, vcs=None):
         if vcs is not None:
@@ -221,12 +438,24 @@ class Seed(object):
         else:
             return self._open_seed_url(base, branch, name)
 
-    def __init__(self, bases, branches, name, vcs=None):
-        """Read a seed from a collection."""
-        if isinstance(branches, _string_types):
+    def __init__(self, bases, branches, name, vcs=None, cache_dir=None):
+        """Read a seed from a collection.
+
+        If cache_dir is given, seeds downloaded over HTTP are kept there
+        and only downloaded again when they change.
+        """
+        if isinstance(branches, str):
             branches = [branches]
 
         self._name = name
+        self._cache_dir = cache_dir
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # Perhaps somebody else created it at the same time.
+                if not os.path.isdir(cache_dir):
+                    raise
         self._base = None
         self._branch = None
         self._file = None
@@ -241,8 +470,7 @@ class Seed(object):
                     self._branch = branch
                     break
                 except SeedError:
-                    ssh_match = re.match(
-                        r'(?:bzr|git)\+ssh://(?:[^/]*?@)?(.*?)(?:/|$)', base)
+                    ssh_match = _ssh_host.match(base)
                     if ssh_match:
                         ssh_host = ssh_match.group(1)
                 except (OSError, IOError, URLError):
@@ -270,26 +498,21 @@ class Seed(object):
                 _logger.warning("Could not open (any of):")
                 for base in bases:
                     for branch in branches:
-                        path = os.path.join(base, branch)
-                        if not path.endswith('/'):
-                            path += '/'
+                        path = _join_dir(base, branch)
                         _logger.warning('  %s' % urljoin(path, name))
             raise SeedError("Could not open %s" % name)
 
         try:
             self._text = fd.read()
-            # In Python 3, we need to decode seed text read from URLs.
-            if sys.version_info[0] >= 3 and isinstance(self._text, bytes):
+            # Seed text read from URLs and caches needs to be decoded.
+            if isinstance(self._text, bytes):
                 self._text = self._text.decode(errors="replace")
         finally:
             fd.close()
 
     def open(self):
         """Open a file object with the text of this seed."""
-        if sys.version_info[0] < 3:
-            self._file = io.BytesIO(self._text)
-        else:
-            self._file = io.StringIO(self._text)
+        self._file = io.StringIO(self._text)
         return self._file
 
     def read(self, *args, **kwargs):
@@ -308,9 +531,6 @@ class Seed(object):
         """Read the next line from this seed."""
         return next(self._file)
 
-    if sys.version < '3':
-        next = __next__
-
     def close(self):
         """Close the file object for this seed."""
         self._file.close()
@@ -445,7 +665,7 @@ class SingleSeedStructure(object):
                 _logger.error("Unparseable seed structure entry: %s", line)
 
 
-class SeedStructure(collections.Mapping, object):
+class SeedStructure(Mapping, object):
     """The full structure of a seed collection.
 
     This deals with acquiring the seed structure files and recursively
@@ -453,8 +673,11 @@ class SeedStructure(collections.Mapping, object):
 
     """
 
-    def __init__(self, branch, seed_bases=None, vcs=None):
-        """Open a seed collection and read all the seeds it contains."""
+    def __init__(self, branch, seed_bases=None, vcs=None, cache_dir=None):
+        """Open a seed collection and read all the seeds it contains.
+
+        If cache_dir is given, seeds downloaded over HTTP are cached there.
+        """
         if seed_bases is None:
             if vcs is None:
                 seed_bases = germinate.defaults.seeds
@@ -467,46 +690,84 @@ class SeedStructure(collections.Mapping, object):
         self._seed_bases = seed_bases
         self._branch = branch
         self._vcs = vcs
+        self._cache_dir = cache_dir
         self._features = set()
-        self._seed_order, self._inherit, branches, self._lines = \
-            self._parse(self._branch, set())
-        self._seeds = {}
-        for seed in self._seed_order:
-            self._seeds[seed] = self.make_seed(
-                seed_bases, branches, seed, vcs=vcs)
+        # Included branches are fetched in parallel; for VCS seed
+        # collections, this is when they are checked out.  The seeds
+        # themselves are then all fetched at once too.
+        with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+            self._seed_order, self._inherit, branches, lines = \
+                self._parse(self._branch, set(), executor, {})
+            self._lines = list(lines.values())
+            pending = {}
+            for seed in self._seed_order:
+                if seed not in pending:
+                    pending[seed] = self._start_seed(
+                        executor, seed_bases, branches, seed, vcs=vcs)
+            self._seeds = {}
+            for seed in self._seed_order:
+                self._seeds[seed] = pending[seed]()
         self._expand_inheritance()
 
-    def _parse(self, branch, got_branches):
+    def _start_seed(self, executor, bases, branches, name, vcs=None):
+        """Start reading a seed, returning a function that finishes it.
+
+        Overrides of make_seed need not be thread-safe, so they are only
+        called (by the returned function) from this thread.  Our own
+        make_seed is run straight away in a worker thread instead.
+        """
+        if type(self).make_seed is SeedStructure.make_seed:
+            return executor.submit(
+                SeedStructure.make_seed, self, bases, branches, name,
+                vcs=vcs).result
+        else:
+            return functools.partial(
+                self.make_seed, bases, branches, name, vcs=vcs)
+
+    def _fetch_structure(self, branch):
+        return self.make_seed(
+            self._seed_bases, branch, "STRUCTURE", self._vcs)
+
+    def _parse(self, branch, got_branches, executor, pending):
         all_seed_order = []
         all_inherit = {}
         all_branches = []
-        all_structure = []
+        # seed name -> STRUCTURE line; a later line for the same seed
+        # replaces an earlier one, and moves to the end.
+        all_structure = collections.OrderedDict()
 
-        # Fetch this one
-        with self.make_seed(
-                self._seed_bases, branch, "STRUCTURE", self._vcs) as seed:
+        # Fetch this one, unless it is already on its way
+        if branch in pending:
+            structure_seed = pending.pop(branch)()
+        else:
+            structure_seed = self._fetch_structure(branch)
+        with structure_seed as seed:
             structure = SingleSeedStructure(branch, seed)
         got_branches.add(branch)
 
+        # Start fetching all the included branches at once
+        for child_branch in structure.branches:
+            if (child_branch not in got_branches and
+                    child_branch not in pending):
+                pending[child_branch] = self._start_seed(
+                    executor, self._seed_bases, child_branch, "STRUCTURE",
+                    self._vcs)
+
         # Recursively expand included branches
         for child_branch in structure.branches:
             if child_branch in got_branches:
                 continue
             (child_seed_order, child_inherit, child_branches,
-             child_structure) = self._parse(child_branch, got_branches)
+             child_structure) = self._parse(
+                child_branch, got_branches, executor, pending)
             all_seed_order.extend(child_seed_order)
             all_inherit.update(child_inherit)
             for grandchild_branch in child_branches:
                 if grandchild_branch not in all_branches:
                     all_branches.append(grandchild_branch)
-            for child_structure_line in child_structure:
-                child_structure_name = child_structure_line.split()[0][:-1]
-                for i in range(len(all_structure)):
-                    if (all_structure[i].split()[0][:-1] ==
-                        child_structure_name):
-                        del all_structure[i]
-                        break
-                all_structure.append(child_structure_line)
+            for child_name, child_line in child_structure.items():
+                all_structure.pop(child_name, None)
+                all_structure[child_name] = child_line
 
         # Attach the main branch's data to the end
         all_seed_order.extend(structure.seed_order)
@@ -514,13 +775,12 @@ class SeedStructure(collections.Mapping, object):
         for child_branch in structure.branches:
             if child_branch not in all_branches:
                 all_branches.append(child_branch)
-        for structure_line in structure.lines:
-            structure_name = structure_line.split()[0][:-1]
-            for i in range(len(all_structure)):
-                if all_structure[i].split()[0][:-1] == structure_name:
-                    del all_structure[i]
-                    break
-            all_structure.append(structure_line)
+        # seed_order and lines are parallel, so there is no need to split
+        # each line again to find its seed name.
+        for structure_name, structure_line in zip(
+                structure.seed_order, structure.lines):
+            all_structure.pop(structure_name, None)
+            all_structure[structure_name] = structure_line
         self._features.update(structure.features)
 
         # We generally want to process branches in reverse order, so that
@@ -533,27 +793,25 @@ class SeedStructure(collections.Mapping, object):
         """Read a seed from this collection.
 
         This can be overridden by subclasses in order to read seeds in a
-        different way.
+        different way.  It is only ever called from the thread that
+        created the SeedStructure.
         """
-        return Seed(bases, branches, name, vcs=vcs)
+        return Seed(bases, branches, name, vcs=vcs, cache_dir=self._cache_dir)
 
     def _expand_inheritance(self):
         """Expand out incomplete inheritance lists."""
         self._original_inherit = dict(self._inherit)
 
         self._names = topo_sort(self._inherit)
+        # In topological order, each parent's list has already been
+        # expanded, so it is enough to concatenate the parents' lists
+        # (each followed by the parent itself) and drop duplicates.
         for name in self._names:
-            seen = set()
-            new_inherit = []
-            for inheritee in self._inherit[name]:
-                for expanded in self._inherit[inheritee]:
-                    if expanded not in seen:
-                        new_inherit.append(expanded)
-                        seen.add(expanded)
-                if inheritee not in seen:
-                    new_inherit.append(inheritee)
-                    seen.add(inheritee)
-            self._inherit[name] = new_inherit
+            self._inherit[name] = list(collections.OrderedDict.fromkeys(
+                itertools.chain.from_iterable(
+                    self._inherit[inheritee] + [inheritee]
+                    for inheritee in self._inherit[name])))
+        self._outer = None
 
     def limit(self, seeds):
         """Restrict the seeds we care about to this list."""
@@ -564,6 +822,7 @@ class SeedStructure(collections.Mapping, object):
                     self._names.append(inherit)
             if name not in self._names:
                 self._names.append(name)
+        self._outer = None
 
     def add(self, name, entries, parent=None):
         """Add a custom seed."""
@@ -573,6 +832,7 @@ class SeedStructure(collections.Mapping, object):
         else:
             self._inherit[name] = [parent]
         self._seeds[name] = CustomSeed(name, entries)
+        self._outer = None
 
     def inner_seeds(self, seedname):
         """Return this seed and the seeds from which it inherits."""
@@ -582,11 +842,14 @@ class SeedStructure(collections.Mapping, object):
 
     def strictly_outer_seeds(self, seedname):
         """Return the seeds that inherit from this seed."""
-        outerseeds = []
-        for seed in self._names:
-            if seedname in self._inherit[seed]:
-                outerseeds.append(seed)
-        return outerseeds
+        # This is called a lot while growing, so work out the answer for
+        # every seed at once.
+        if self._outer is None:
+            self._outer = {}
+            for seed in self._names:
+                for inherit in self._inherit[seed]:
+                    self._outer.setdefault(inherit, []).append(seed)
+        return list(self._outer.get(seedname, []))
 
     def outer_seeds(self, seedname):
         """Return this seed and the seeds that inherit from it."""
@@ -606,6 +869,29 @@ class SeedStructure(collections.Mapping, object):
         """Get a particular seed from this collection."""
         return self._seeds[seedname]
 
+    # The Mapping mixins would go through __getitem__ for every seed; the
+    # underlying dict can answer these directly.
+
+    def __contains__(self, seedname):
+        """Test whether a seed is in this collection."""
+        return seedname in self._seeds
+
+    def get(self, seedname, default=None):
+        """Get a particular seed, or default if it is not present."""
+        return self._seeds.get(seedname, default)
+
+    def keys(self):
+        """Return a view of the seed names in this collection."""
+        return self._seeds.keys()
+
+    def items(self):
+        """Return a view of (name, seed) pairs in this collection."""
+        return self._seeds.items()
+
+    def values(self):
+        """Return a view of the seeds in this collection."""
+        return self._seeds.values()
+
     @property
     def branch(self):
         """The name of this seed collection branch."""
@@ -634,22 +920,24 @@ class SeedStructure(collections.Mapping, object):
 
     def write_dot(self, filename):
         """Write a dot file representing this structure."""
-        with AtomicFile(filename) as dotfile:
-            print("digraph structure {", file=dotfile)
-            print("    node [color=lightblue2, style=filled];", file=dotfile)
-
-            for seed in self._seed_order:
-                if seed not in self._original_inherit:
-                    continue
-                for inherit in self._original_inherit[seed]:
-                    print("    \"%s\" -> \"%s\";" % (inherit, seed),
-                          file=dotfile)
+        lines = [
+            "digraph structure {",
+            "    node [color=lightblue2, style=filled];",
+        ]
+        for seed in self._seed_order:
+            if seed not in self._original_inherit:
+                continue
+            for inherit in self._original_inherit[seed]:
+                lines.append("    \"%s\" -> \"%s\";" % (inherit, seed))
+        lines.append("}")
 
-            print("}", file=dotfile)
+        with AtomicFile(filename) as dotfile:
+            dotfile.write("\n".join(lines) + "\n")
 
     def write_seed_text(self, filename, seedname):
         """Write the text of a seed in this collection."""
+        text = self._seeds[seedname].text
+        if text and not text.endswith('\n'):
+            text += '\n'
         with AtomicFile(filename) as f:
-            with self._seeds[seedname] as seed:
-                for line in seed:
-                    print(_ensure_unicode(line.rstrip('\n')), file=f)
+            f.write(_ensure_unicode(text))
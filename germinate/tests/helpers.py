@@ -21,11 +21,14 @@
 from __future__ import print_function
 
 import errno
+import functools
+from http.server import HTTPServer, SimpleHTTPRequestHandler
 import io
 import os
 import shutil
 import sys
 import tempfile
+import threading
 try:
     import unittest2 as unittest
 except ImportError:
@@ -70,6 +73,22 @@ class TestCase(unittest.TestCase):
         self.seeds_dir = os.path.join(self.temp_dir, "seeds")
         os.makedirs(self.seeds_dir)
 
+    def serveHTTP(self, directory, handler=SimpleHTTPRequestHandler):
+        """Serve directory over HTTP until the test finishes.
+
+        Returns the base URL of the server.
+        """
+        server = HTTPServer(
+            ("127.0.0.1", 0), functools.partial(handler, directory=directory))
+        self.addCleanup(server.server_close)
+        # A short poll interval keeps shutdown from delaying each test.
+        thread = threading.Thread(
+            target=server.serve_forever, kwargs={"poll_interval": 0.01})
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.shutdown)
+        return "http://127.0.0.1:%d/" % server.server_port
+
     def ensureDir(self, path):
         try:
             os.makedirs(path)
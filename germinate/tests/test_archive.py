@@ -20,14 +20,73 @@
 
 import bz2
 import gzip
+import hashlib
+from http.server import SimpleHTTPRequestHandler
+import lzma
 import os
-import subprocess
 import textwrap
+import time
+import unittest
+from urllib.parse import quote
 
+from germinate import archive, fetch
 from germinate.archive import IndexType, TagFile
 from germinate.tests.helpers import TestCase
 
 
+# Index contents for the compression tests.  The Maintainer field checks
+# that non-ASCII text survives decompression.
+_PACKAGES = textwrap.dedent(b"""\
+    Package: test
+    Version: 1.0
+    Architecture: i386
+    Maintainer: \xc3\xba\xe1\xb8\x83\xc3\xba\xc3\xb1\xc5\xa7\xc5\xaf\x20\xc4\x91\xc9\x99\x76\xe1\xba\xbd\xc5\x82\xc3\xb5\xe1\xb9\x97\xc3\xa8\xc5\x97\xe1\xb9\xa1
+
+    """.decode("UTF-8")).encode("UTF-8")
+_SOURCES = textwrap.dedent("""\
+    Source: test
+    Version: 1.0
+
+    """).encode("UTF-8")
+
+
+def _write_mirror(mirror_dir, packages, mtime=None):
+    """Write a one-dist mirror with a Packages file and a Release file.
+
+    HTTP only gives modification times to the second, so tests that change
+    a mirror pass a different mtime each time.
+    """
+    dist_dir = os.path.join(mirror_dir, "dists", "unstable")
+    binary_dir = os.path.join(dist_dir, "main", "binary-i386")
+    if not os.path.isdir(binary_dir):
+        os.makedirs(binary_dir)
+    with open(os.path.join(binary_dir, "Packages"), "wb") as packages_file:
+        packages_file.write(packages)
+    with open(os.path.join(dist_dir, "Release"), "w") as release:
+        release.write(textwrap.dedent("""\
+            Suite: unstable
+            SHA256:
+             %s %d main/binary-i386/Packages
+            """ % (hashlib.sha256(packages).hexdigest(), len(packages))))
+    if mtime is not None:
+        for path in (os.path.join(binary_dir, "Packages"),
+                     os.path.join(dist_dir, "Release")):
+            os.utime(path, (mtime, mtime))
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    """Serve files, recording the path and status of each request."""
+
+    requests = None
+
+    def log_request(self, code="-", size="-"):
+        if self.requests is not None:
+            self.requests.append((self.path, int(code)))
+
+    def log_message(self, *args):
+        pass
+
+
 class TestTagFile(TestCase):
     def test_init_lists(self):
         """TagFile may be constructed with list parameters."""
@@ -59,20 +118,10 @@ class TestTagFile(TestCase):
         os.makedirs(source_dir)
         with gzip.GzipFile(
                 os.path.join(binary_dir, "Packages.gz"), "wb") as packages:
-            packages.write(textwrap.dedent(b"""\
-                Package: test
-                Version: 1.0
-                Architecture: i386
-                Maintainer: \xc3\xba\xe1\xb8\x83\xc3\xba\xc3\xb1\xc5\xa7\xc5\xaf\x20\xc4\x91\xc9\x99\x76\xe1\xba\xbd\xc5\x82\xc3\xb5\xe1\xb9\x97\xc3\xa8\xc5\x97\xe1\xb9\xa1
-
-                """.decode("UTF-8")).encode("UTF-8"))
+            packages.write(_PACKAGES)
         with gzip.GzipFile(
                 os.path.join(source_dir, "Sources.gz"), "wb") as sources:
-            sources.write(textwrap.dedent("""\
-                Source: test
-                Version: 1.0
-
-                """).encode("UTF-8"))
+            sources.write(_SOURCES)
 
         tagfile = TagFile(
             "unstable", "main", "i386", "file://%s/mirror" % self.temp_dir)
@@ -95,20 +144,10 @@ class TestTagFile(TestCase):
         os.makedirs(source_dir)
         with bz2.BZ2File(
                 os.path.join(binary_dir, "Packages.bz2"), "wb") as packages:
-            packages.write(textwrap.dedent(b"""\
-                Package: test
-                Version: 1.0
-                Architecture: i386
-                Maintainer: \xc3\xba\xe1\xb8\x83\xc3\xba\xc3\xb1\xc5\xa7\xc5\xaf\x20\xc4\x91\xc9\x99\x76\xe1\xba\xbd\xc5\x82\xc3\xb5\xe1\xb9\x97\xc3\xa8\xc5\x97\xe1\xb9\xa1
-
-                """.decode("UTF-8")).encode("UTF-8"))
+            packages.write(_PACKAGES)
         with bz2.BZ2File(
                 os.path.join(source_dir, "Sources.bz2"), "wb") as sources:
-            sources.write(textwrap.dedent("""\
-                Source: test
-                Version: 1.0
-
-                """).encode("UTF-8"))
+            sources.write(_SOURCES)
 
         tagfile = TagFile(
             "unstable", "main", "i386", "file://%s/mirror" % self.temp_dir)
@@ -129,22 +168,12 @@ class TestTagFile(TestCase):
         source_dir = os.path.join(main_dir, "source")
         os.makedirs(binary_dir)
         os.makedirs(source_dir)
-        with open(os.path.join(binary_dir, "Packages"), "wb") as packages:
-            packages.write(textwrap.dedent(b"""\
-                Package: test
-                Version: 1.0
-                Architecture: i386
-                Maintainer: \xc3\xba\xe1\xb8\x83\xc3\xba\xc3\xb1\xc5\xa7\xc5\xaf\x20\xc4\x91\xc9\x99\x76\xe1\xba\xbd\xc5\x82\xc3\xb5\xe1\xb9\x97\xc3\xa8\xc5\x97\xe1\xb9\xa1
-
-                """.decode("UTF-8")).encode("UTF-8"))
-        subprocess.check_call(["xz", os.path.join(binary_dir, "Packages")])
-        with open(os.path.join(source_dir, "Sources"), "wb") as sources:
-            sources.write(textwrap.dedent("""\
-                Source: test
-                Version: 1.0
-
-                """).encode("UTF-8"))
-        subprocess.check_call(["xz", os.path.join(source_dir, "Sources")])
+        with lzma.open(
+                os.path.join(binary_dir, "Packages.xz"), "wb") as packages:
+            packages.write(_PACKAGES)
+        with lzma.open(
+                os.path.join(source_dir, "Sources.xz"), "wb") as sources:
+            sources.write(_SOURCES)
 
         tagfile = TagFile(
             "unstable", "main", "i386", "file://%s/mirror" % self.temp_dir)
@@ -156,3 +185,327 @@ class TestTagFile(TestCase):
         self.assertEqual(IndexType.SOURCES, sections[1][0])
         self.assertEqual("test", sections[1][1]["Source"])
         self.assertEqual("1.0", sections[1][1]["Version"])
+
+    def test_sections_multiple_components(self):
+        """Sections from several components are yielded in a stable order."""
+        self.useTempDir()
+        for component in ("main", "universe"):
+            binary_dir = os.path.join(
+                "mirror", "dists", "unstable", component, "binary-i386")
+            os.makedirs(binary_dir)
+            with open(os.path.join(binary_dir, "Packages"), "wb") as packages:
+                packages.write(textwrap.dedent("""\
+                    Package: test-%s
+                    Version: 1.0
+                    Architecture: i386
+
+                    """ % component).encode("UTF-8"))
+
+        tagfile = TagFile(
+            "unstable", ["main", "universe"], "i386",
+            "file://%s/mirror" % self.temp_dir, installer_packages=False)
+        sections = list(tagfile.sections())
+        self.assertEqual(
+            [(IndexType.PACKAGES, "test-main"),
+             (IndexType.PACKAGES, "test-universe")],
+            [(index_type, section["Package"])
+             for index_type, section in sections])
+
+    def test_sections_fields(self):
+        """TagFile can restrict sections to a given set of fields."""
+        self.useTempDir()
+        binary_dir = os.path.join(
+            "mirror", "dists", "unstable", "main", "binary-i386")
+        os.makedirs(binary_dir)
+        with open(os.path.join(binary_dir, "Packages"), "wb") as packages:
+            packages.write(textwrap.dedent("""\
+                Package: test
+                Version: 1.0
+                Architecture: i386
+
+                """).encode("UTF-8"))
+
+        tagfile = TagFile(
+            "unstable", "main", "i386", "file://%s/mirror" % self.temp_dir,
+            installer_packages=False,
+            fields={IndexType.PACKAGES: ("Package", "Depends"),
+                    IndexType.SOURCES: ("Package",)})
+        sections = list(tagfile.sections())
+        self.assertEqual([(IndexType.PACKAGES, {"Package": "test"})], sections)
+
+    def test_sections_skips_other_architectures(self):
+        """TagFile skips binary packages for other architectures."""
+        self.useTempDir()
+        binary_dir = os.path.join(
+            "mirror", "dists", "unstable", "main", "binary-i386")
+        os.makedirs(binary_dir)
+        with open(os.path.join(binary_dir, "Packages"), "wb") as packages:
+            packages.write(textwrap.dedent("""\
+                Package: test
+                Version: 1.0
+                Architecture: i386
+
+                Package: test-amd64
+                Version: 1.0
+                Architecture: amd64
+
+                Package: test-all
+                Version: 1.0
+                Architecture: all
+
+                """).encode("UTF-8"))
+
+        tagfile = TagFile(
+            "unstable", "main", "i386", "file://%s/mirror" % self.temp_dir,
+            installer_packages=False)
+        self.assertEqual(
+            ["test", "test-all"],
+            [section["Package"] for _, section in tagfile.sections()])
+
+    def test_sections_missing_sources(self):
+        """A missing Sources file is logged, even if its name has a %."""
+        self.useTempDir()
+        binary_dir = os.path.join(
+            "mirror", "dists", "unstable", "ma%in", "binary-i386")
+        os.makedirs(binary_dir)
+        with open(os.path.join(binary_dir, "Packages"), "wb") as packages:
+            packages.write(_PACKAGES)
+
+        tagfile = TagFile(
+            "unstable", "ma%in", "i386", "file://%s/mirror" % self.temp_dir,
+            installer_packages=False)
+        with self.assertLogs("germinate.archive") as logs:
+            list(tagfile.sections())
+        self.assertIn(
+            "Missing Source Packages file for ma%in (ignoring)",
+            [record.getMessage() for record in logs.records])
+
+    def test_sections_release_file(self):
+        """TagFile only fetches index files listed in Release, if any."""
+        self.useTempDir()
+        dist_dir = os.path.join("mirror", "dists", "unstable")
+        binary_dir = os.path.join(dist_dir, "main", "binary-i386")
+        os.makedirs(binary_dir)
+        with open(os.path.join(binary_dir, "Packages"), "wb") as packages:
+            packages.write(textwrap.dedent("""\
+                Package: test
+                Version: 1.0
+                Architecture: i386
+
+                """).encode("UTF-8"))
+        with gzip.GzipFile(
+                os.path.join(binary_dir, "Packages.gz"), "wb") as packages:
+            packages.write(textwrap.dedent("""\
+                Package: test-old
+                Version: 0.9
+                Architecture: i386
+
+                """).encode("UTF-8"))
+        with open(os.path.join(dist_dir, "Release"), "w") as release:
+            release.write(textwrap.dedent("""\
+                Suite: unstable
+                SHA256:
+                 %s 50 main/binary-i386/Packages
+                """ % ("0" * 64)))
+
+        tagfile = TagFile(
+            "unstable", "main", "i386", "file://%s/mirror" % self.temp_dir,
+            installer_packages=False)
+        self.assertEqual(
+            ["test"],
+            [section["Package"] for _, section in tagfile.sections()])
+
+    def test_sections_http_content_encoding(self):
+        """Compressed files served with a Content-Encoding stay compressed."""
+        self.useTempDir()
+        binary_dir = os.path.join(
+            "mirror", "dists", "unstable", "main", "binary-i386")
+        os.makedirs(binary_dir)
+        with gzip.GzipFile(
+                os.path.join(binary_dir, "Packages.gz"), "wb") as packages:
+            packages.write(_PACKAGES)
+
+        class Handler(SimpleHTTPRequestHandler):
+            def end_headers(self):
+                if self.path.endswith(".gz"):
+                    self.send_header("Content-Encoding", "gzip")
+                SimpleHTTPRequestHandler.end_headers(self)
+
+            def log_message(self, *args):
+                pass
+
+        base = self.serveHTTP(os.path.join(self.temp_dir, "mirror"), Handler)
+        tagfile = TagFile(
+            "unstable", "main", "i386", base, installer_packages=False,
+            cache_dir="cache")
+        self.assertEqual(
+            ["test"],
+            [section["Package"] for _, section in tagfile.sections()])
+
+    def test_sections_http_no_cache_dir(self):
+        """Without a cache directory, updated files replace old copies."""
+        self.useTempDir()
+        mirror_dir = os.path.join(self.temp_dir, "mirror")
+        base = self.serveHTTP(mirror_dir, _QuietHandler)
+        os.mkdir("work")
+        os.chdir("work")
+        for mtime, version in ((1000000000, "1.0"), (1000000100, "2.0")):
+            _write_mirror(mirror_dir, textwrap.dedent("""\
+                Package: test
+                Version: %s
+                Architecture: i386
+
+                """ % version).encode("UTF-8"), mtime=mtime)
+            tagfile = TagFile(
+                "unstable", "main", "i386", base, installer_packages=False)
+            self.assertEqual(
+                [version],
+                [section["Version"] for _, section in tagfile.sections()])
+        self.assertEqual(
+            1, len([name for name in os.listdir(".")
+                    if name.endswith("_Packages")]))
+
+    def test_sections_http_no_validators(self):
+        """Cached files that cannot be revalidated are fetched again."""
+        self.useTempDir()
+        mirror_dir = os.path.join(self.temp_dir, "mirror")
+        _write_mirror(mirror_dir, _PACKAGES)
+        requests = []
+
+        class Handler(_QuietHandler):
+            def send_header(self, keyword, value):
+                if keyword != "Last-Modified":
+                    _QuietHandler.send_header(self, keyword, value)
+
+        Handler.requests = requests
+        base = self.serveHTTP(mirror_dir, Handler)
+        for _ in range(2):
+            tagfile = TagFile(
+                "unstable", "main", "i386", base, installer_packages=False,
+                cache_dir="cache")
+            list(tagfile.sections())
+        self.assertEqual(
+            [("/dists/unstable/Release", 200)] * 2,
+            [request for request in requests if "Release" in request[0]])
+
+    def test_sections_http_leftover_files(self):
+        """Fetching leaves one lock per index, and only in a cache."""
+        self.useTempDir()
+        mirror_dir = os.path.join(self.temp_dir, "mirror")
+        _write_mirror(mirror_dir, _PACKAGES)
+        base = self.serveHTTP(mirror_dir, _QuietHandler)
+        os.mkdir("work")
+        os.chdir("work")
+        for cache_dir in ("cache", None):
+            tagfile = TagFile(
+                "unstable", "main", "i386", base, installer_packages=False,
+                cache_dir=cache_dir)
+            list(tagfile.sections())
+        prefix = "%s_unstable_" % quote(base, safe="")
+        self.assertEqual(
+            [prefix + "Release.lock",
+             prefix + "main_binary-i386_Packages.lock",
+             prefix + "main_source_Sources.lock"],
+            sorted(name for name in os.listdir("cache")
+                   if name.endswith(".lock")))
+        # The Packages file was checked against Release, so needs no
+        # validators.
+        self.assertEqual(
+            [prefix + "Release.mtime"],
+            sorted(name for name in os.listdir("cache")
+                   if name.endswith((".etag", ".mtime"))))
+        self.assertEqual(
+            [], [name for name in os.listdir(".") if name.endswith(".lock")])
+
+    def _serve_mirror(self, packages=_PACKAGES, release=True):
+        """Serve a mirror over HTTP, returning its URL and a request log."""
+        mirror_dir = os.path.join(self.temp_dir, "mirror")
+        _write_mirror(mirror_dir, packages)
+        if not release:
+            os.unlink(os.path.join(mirror_dir, "dists", "unstable", "Release"))
+        requests = []
+
+        class Handler(_QuietHandler):
+            pass
+
+        Handler.requests = requests
+        return self.serveHTTP(mirror_dir, Handler), requests
+
+    def _read_packages(self, base):
+        tagfile = TagFile(
+            "unstable", "main", "i386", base, installer_packages=False,
+            cache_dir="cache")
+        return [section["Package"] for _, section in tagfile.sections()]
+
+    def _check_conditional_get(self):
+        self.useTempDir()
+        base, requests = self._serve_mirror(release=False)
+        for _ in range(2):
+            self.assertEqual(["test"], self._read_packages(base))
+        self.assertEqual(
+            [200, 304],
+            [status for path, status in requests
+             if path == "/dists/unstable/main/binary-i386/Packages"])
+        self.assertEqual(
+            1, len([name for name in os.listdir("cache")
+                    if name.endswith("_Packages")]))
+
+    def test_sections_http_conditional_get(self):
+        """Cached files are revalidated using their saved validators."""
+        self.addCleanup(setattr, fetch, "_http", fetch._http)
+        fetch._http = None
+        self._check_conditional_get()
+
+    @unittest.skipIf(fetch._http is None, "urllib3 not available")
+    def test_sections_http_conditional_get_urllib3(self):
+        """Revalidation works through the urllib3 connection pool too."""
+        self._check_conditional_get()
+
+    def test_sections_http_checksum_hit(self):
+        """Files whose checksums are cached are not fetched again."""
+        self.useTempDir()
+        base, requests = self._serve_mirror()
+        for _ in range(2):
+            self.assertEqual(["test"], self._read_packages(base))
+        self.assertEqual(
+            [200],
+            [status for path, status in requests
+             if path == "/dists/unstable/main/binary-i386/Packages"])
+        self.assertEqual(
+            ["%s_Packages" % hashlib.sha256(_PACKAGES).hexdigest()],
+            [name for name in os.listdir("cache")
+             if name.endswith("_Packages")])
+
+    def test_sections_http_checksum_mismatch(self):
+        """Mismatched downloads are used, but not cached as verified."""
+        self.useTempDir()
+        base, _ = self._serve_mirror()
+        with open(os.path.join(
+                self.temp_dir, "mirror", "dists", "unstable", "main",
+                "binary-i386", "Packages"), "ab") as packages:
+            packages.write(b"Package: ahead\n\n")
+        with self.assertLogs("germinate.archive", "WARNING") as logs:
+            self.assertEqual(["test", "ahead"], self._read_packages(base))
+        self.assertIn("using it unverified", logs.output[0])
+        self.assertEqual(
+            [quote(base, safe="") + "_unstable_main_binary-i386_Packages"],
+            [name for name in os.listdir("cache")
+             if name.endswith("_Packages")])
+
+    def test_sections_http_prune(self):
+        """Superseded checksum-named files are pruned once unused."""
+        self.useTempDir()
+        base, _ = self._serve_mirror()
+        self.assertEqual(["test"], self._read_packages(base))
+        old = os.path.join(
+            "cache", "%s_Packages" % hashlib.sha256(_PACKAGES).hexdigest())
+        stale = time.time() - archive._CACHE_MAX_AGE - 60
+        os.utime(old, (stale, stale))
+        packages = _PACKAGES.replace(b"test", b"test-new")
+        _write_mirror(
+            os.path.join(self.temp_dir, "mirror"), packages,
+            mtime=time.time() + 60)
+        self.assertEqual(["test-new"], self._read_packages(base))
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(os.path.join(
+            "cache", "%s_Packages" % hashlib.sha256(packages).hexdigest())))
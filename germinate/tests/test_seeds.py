@@ -18,14 +18,21 @@
 # Software Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
 # 02110-1301, USA.
 
+from http.server import SimpleHTTPRequestHandler
 import io
 import os
 import textwrap
+import threading
+from urllib.error import HTTPError
 
 from germinate.seeds import (
     AtomicFile,
     Seed,
+    SeedError,
+    SeedStructure,
+    SeedVcs,
     SingleSeedStructure,
+    _git_raw_url,
     )
 from germinate.tests.helpers import TestCase, u
 
@@ -46,6 +53,54 @@ class TestAtomicFile(TestCase):
             pass
         self.assertFalse(os.path.exists("foo.new"))
 
+    def test_write_method(self):
+        """AtomicFile.write writes to the new file."""
+        self.useTempDir()
+        atomic = AtomicFile("foo")
+        with atomic:
+            atomic.write("string")
+        with open("foo") as handle:
+            self.assertEqual("string", handle.read())
+
+    def test_failure_keeps_old_contents(self):
+        """AtomicFile leaves the file alone if writing fails."""
+        self.useTempDir()
+        with AtomicFile("foo") as test:
+            test.write("old")
+        with self.assertRaises(ValueError):
+            with AtomicFile("foo") as test:
+                test.write("new")
+                raise ValueError
+        with open("foo") as handle:
+            self.assertEqual("old", handle.read())
+
+
+class TestGitRawUrl(TestCase):
+    def test_launchpad(self):
+        """Launchpad git branches are fetched from cgit's plain view."""
+        self.assertEqual(
+            "https://git.launchpad.net/~owner/seeds/+git/ubuntu/plain/"
+            "STRUCTURE?h=trusty",
+            _git_raw_url(
+                "git://git.launchpad.net/~owner/seeds/+git/", "ubuntu",
+                "trusty", "STRUCTURE"))
+
+    def test_github(self):
+        """GitHub branches are fetched from raw.githubusercontent.com."""
+        self.assertEqual(
+            "https://raw.githubusercontent.com/owner/seeds/HEAD/STRUCTURE",
+            _git_raw_url(
+                "https://github.com/owner/", "seeds", None, "STRUCTURE"))
+
+    def test_unknown_host(self):
+        """Other hosts and ssh URLs have no raw file URL."""
+        self.assertIsNone(
+            _git_raw_url("git://example.org/", "seeds", None, "STRUCTURE"))
+        self.assertIsNone(
+            _git_raw_url(
+                "git+ssh://git.launchpad.net/~owner/seeds/+git/", "ubuntu",
+                None, "STRUCTURE"))
+
 
 class TestSeed(TestCase):
     def setUp(self):
@@ -90,6 +145,99 @@ class TestSeed(TestCase):
             ["file://%s" % self.seeds_dir], ["collection.dist"], "test3")
         self.assertNotEqual(one, three)
 
+    def test_cache_dir(self):
+        """Seeds fetched over HTTP are only downloaded again if changed."""
+        statuses = []
+
+        class Handler(SimpleHTTPRequestHandler):
+            def log_request(self, code="-", size="-"):
+                statuses.append(int(code))
+
+        base = self.serveHTTP(self.seeds_dir, Handler)
+        cache_dir = os.path.join(self.temp_dir, "cache")
+
+        for _ in range(2):
+            seed = Seed([base], ["collection.dist"], "test",
+                        cache_dir=cache_dir)
+            self.assertEqual(" * foo\n", seed.text)
+        self.assertEqual([200, 304], statuses)
+
+    def test_cache_dir_missing_body(self):
+        """A cached seed whose body has gone is downloaded again."""
+        statuses = []
+
+        class Handler(SimpleHTTPRequestHandler):
+            def log_request(self, code="-", size="-"):
+                statuses.append(int(code))
+
+        base = self.serveHTTP(self.seeds_dir, Handler)
+        cache_dir = os.path.join(self.temp_dir, "cache")
+
+        Seed([base], ["collection.dist"], "test", cache_dir=cache_dir)
+        for name in os.listdir(cache_dir):
+            if "." not in name:
+                os.unlink(os.path.join(cache_dir, name))
+        seed = Seed([base], ["collection.dist"], "test", cache_dir=cache_dir)
+        self.assertEqual(" * foo\n", seed.text)
+        self.assertEqual([200, 200], statuses)
+
+    def test_cache_dir_network_failure(self):
+        """A cached seed is used if it cannot be revalidated."""
+        requests = []
+
+        class Handler(SimpleHTTPRequestHandler):
+            def do_GET(self):
+                requests.append(self.path)
+                if len(requests) > 1:
+                    # Hang up without answering.
+                    self.close_connection = True
+                    return
+                SimpleHTTPRequestHandler.do_GET(self)
+
+            def log_message(self, *args):
+                pass
+
+        base = self.serveHTTP(self.seeds_dir, Handler)
+        cache_dir = os.path.join(self.temp_dir, "cache")
+
+        Seed([base], ["collection.dist"], "test", cache_dir=cache_dir)
+        with self.assertLogs("germinate.seeds", "WARNING"):
+            seed = Seed(
+                [base], ["collection.dist"], "test", cache_dir=cache_dir)
+        self.assertEqual(" * foo\n", seed.text)
+        self.assertEqual(2, len(requests))
+
+    def test_git_raw_not_found_tries_bzr(self):
+        """With SeedVcs.AUTO, a seed missing from git is tried in bzr."""
+        attempts = []
+
+        class TestSeed(Seed):
+            def _open_url(self, url):
+                attempts.append("git")
+                raise HTTPError(url, 404, "Not Found", {}, None)
+
+            def _open_seed_bzr(self, base, branch, name):
+                attempts.append("bzr")
+                return io.StringIO(" * foo\n")
+
+        seed = TestSeed(
+            ["https://git.launchpad.net/~owner/seeds/+git/"],
+            ["ubuntu.trusty"], "test", vcs=SeedVcs.AUTO)
+        self.assertEqual(" * foo\n", seed.text)
+        self.assertEqual(["git", "bzr"], attempts)
+
+    def test_git_raw_not_found(self):
+        """A seed missing from git is a SeedError."""
+        class TestSeed(Seed):
+            def _open_url(self, url):
+                raise HTTPError(url, 404, "Not Found", {}, None)
+
+        with self.assertLogs("germinate.seeds", "WARNING"):
+            self.assertRaises(
+                SeedError, TestSeed,
+                ["https://git.launchpad.net/~owner/seeds/+git/"],
+                ["ubuntu.trusty"], "test", vcs=SeedVcs.GIT)
+
     def test_open_without_scheme(self):
         """A Seed can be opened from a relative path on the filesystem."""
         seed = Seed([self.seeds_dir], ["collection.dist"], "test")
@@ -175,6 +323,52 @@ class TestSeedStructure(TestCase):
         self.assertEqual(two, structure["desktop"].branch)
         self.assertEqual(" * desktop-package\n", structure["desktop"].text)
 
+    def test_make_seed_override(self):
+        """An overridden make_seed is only called from the main thread."""
+        one = "one.dist"
+        two = "two.dist"
+        self.addSeed(one, "base")
+        self.addSeedPackage(one, "base", "base-package")
+        self.addStructureLine(two, "include one.dist")
+        self.addSeed(two, "desktop")
+        self.addSeedPackage(two, "desktop", "desktop-package")
+        calls = []
+
+        class TestSeedStructure(SeedStructure):
+            def make_seed(self, bases, branches, name, vcs=None):
+                calls.append((name, threading.current_thread()))
+                return super(TestSeedStructure, self).make_seed(
+                    bases, branches, name, vcs=vcs)
+
+        structure = TestSeedStructure(
+            two, seed_bases=["file://%s" % self.seeds_dir])
+        self.assertEqual(" * base-package\n", structure["base"].text)
+        self.assertEqual(
+            [("STRUCTURE", threading.main_thread())] * 2 +
+            [("base", threading.main_thread()),
+             ("desktop", threading.main_thread())],
+            calls)
+
+    def test_multiple_shared_include(self):
+        """A branch included more than once is only read once."""
+        one = "one.dist"
+        two = "two.dist"
+        three = "three.dist"
+        self.addSeed(one, "base")
+        self.addSeedPackage(one, "base", "base-package")
+        self.addStructureLine(two, "include one.dist")
+        self.addSeed(two, "desktop")
+        self.addSeedPackage(two, "desktop", "desktop-package")
+        self.addStructureLine(three, "include two.dist one.dist")
+        self.addSeed(three, "server")
+        self.addSeedPackage(three, "server", "server-package")
+        structure = self.openSeedStructure(three)
+        self.assertEqual(
+            ["base", "desktop", "server"], sorted(structure.names))
+        self.assertEqual(one, structure["base"].branch)
+        self.assertEqual(two, structure["desktop"].branch)
+        self.assertEqual(three, structure["server"].branch)
+
     def test_later_branches_override_earlier_branches(self):
         """Seeds from later branches override seeds from earlier branches."""
         one = "one.dist"
@@ -225,6 +419,29 @@ class TestSeedStructure(TestCase):
         self.assertEqual(
             " * custom-one\n * custom-two\n", structure["custom"].text)
 
+    def test_outer_seeds(self):
+        """SeedStructure.outer_seeds follows added and limited seeds."""
+        branch = "collection.dist"
+        self.addSeed(branch, "base")
+        self.addSeedPackage(branch, "base", "base")
+        self.addSeed(branch, "desktop", parents=["base"])
+        self.addSeedPackage(branch, "desktop", "desktop")
+        self.addSeed(branch, "server", parents=["base"])
+        self.addSeedPackage(branch, "server", "server")
+        structure = self.openSeedStructure(branch)
+        self.assertEqual(
+            ["base", "desktop", "server"],
+            sorted(structure.outer_seeds("base")))
+        self.assertEqual(["desktop"], structure.outer_seeds("desktop"))
+        structure.add("custom", [" * custom"], "desktop")
+        self.assertEqual(
+            ["base", "custom", "desktop", "server"],
+            sorted(structure.outer_seeds("base")))
+        self.assertEqual(
+            ["desktop", "custom"], structure.outer_seeds("desktop"))
+        structure.limit(["server"])
+        self.assertEqual(["base", "server"], structure.outer_seeds("base"))
+
     def test_write(self):
         """SeedStructure.write writes the text of STRUCTURE."""
         branch = "collection.dist"
@@ -237,6 +454,23 @@ class TestSeedStructure(TestCase):
         with open("structure") as structure_file:
             self.assertEqual("one:\ntwo: one\n", structure_file.read())
 
+    def test_write_multiple(self):
+        """SeedStructure.write lets later branches override STRUCTURE lines."""
+        one = "one.dist"
+        two = "two.dist"
+        self.addSeed(one, "desktop")
+        self.addSeedPackage(one, "desktop", "desktop-package-one")
+        self.addSeed(one, "base")
+        self.addSeedPackage(one, "base", "base-package")
+        self.addStructureLine(two, "include one.dist")
+        self.addSeed(two, "desktop", parents=["base"])
+        self.addSeedPackage(two, "desktop", "desktop-package-two")
+        structure = self.openSeedStructure(two)
+        structure.write("structure")
+        with open("structure") as structure_file:
+            self.assertEqual(
+                "base:\ndesktop: base\n", structure_file.read())
+
     def test_write_dot(self):
         """SeedStructure.write_dot writes an appropriate dot file."""
         branch = "collection.dist"
@@ -266,6 +500,17 @@ class TestSeedStructure(TestCase):
         with open("one.seedtext") as seed_file:
             self.assertEqual(" * one-package\n", seed_file.read())
 
+    def test_write_seed_text_no_final_newline(self):
+        """SeedStructure.write_seed_text terminates the last line."""
+        branch = "collection.dist"
+        self.addSeed(branch, "one")
+        with open(os.path.join(self.seeds_dir, branch, "one"), "w") as f:
+            f.write(" * one-package")
+        structure = self.openSeedStructure(branch)
+        structure.write_seed_text("one.seedtext", "one")
+        with open("one.seedtext") as seed_file:
+            self.assertEqual(" * one-package\n", seed_file.read())
+
     def test_write_seed_text_utf8(self):
         """SeedStructure.write_seed_text handles UTF-8 text in seeds."""
         branch = "collection.dist"
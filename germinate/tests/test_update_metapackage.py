@@ -0,0 +1,211 @@
+#! /usr/bin/env python
+"""Unit tests for germinate.scripts.germinate_update_metapackage."""
+
+# Copyright (C) 2012 Canonical Ltd.
+#
+# Germinate is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any
+# later version.
+#
+# Germinate is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Germinate; see the file COPYING.  If not, write to the Free
+# Software Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA
+# 02110-1301, USA.
+
+import io
+import logging
+import sys
+import textwrap
+import unittest
+
+from germinate import fetch
+from germinate.log import GerminateFormatter
+from germinate.scripts import germinate_update_metapackage
+from germinate.scripts.germinate_update_metapackage import (
+    add_changelog_items,
+    )
+from germinate.tests.helpers import TestCase
+
+
+_OLD_ENTRY = textwrap.dedent("""\
+    ubuntu-meta (1.0) unstable; urgency=medium
+
+      * Initial release.
+
+     -- Jane Doe <jane@example.org>  Wed, 14 Oct 2026 10:00:00 +0000
+    """)
+
+
+class TestAddChangelogItems(TestCase):
+    def write_changelog(self, text):
+        self.useTempDir()
+        with open("changelog", "w") as changelog:
+            changelog.write(text)
+
+    def read_changelog(self):
+        with open("changelog") as changelog:
+            return changelog.read()
+
+    def test_new_entry(self):
+        """Items are added after those in an entry that dch -i created."""
+        self.write_changelog(textwrap.dedent("""\
+            ubuntu-meta (1.1) UNRELEASED; urgency=medium
+
+              * Refreshed dependencies
+
+             -- Jane Doe <jane@example.org>  Thu, 15 Oct 2026 10:00:00 +0000
+
+            """) + _OLD_ENTRY)
+        add_changelog_items(
+            ["Added foo to desktop", "Removed bar from desktop"],
+            changelog="changelog")
+        self.assertEqual(textwrap.dedent("""\
+            ubuntu-meta (1.1) UNRELEASED; urgency=medium
+
+              * Refreshed dependencies
+              * Added foo to desktop
+              * Removed bar from desktop
+
+             -- Jane Doe <jane@example.org>  Thu, 15 Oct 2026 10:00:00 +0000
+
+            """) + _OLD_ENTRY, self.read_changelog())
+
+    def test_existing_entry(self):
+        """Items are added to an existing UNRELEASED entry."""
+        self.write_changelog(textwrap.dedent("""\
+            ubuntu-meta (1.1) UNRELEASED; urgency=medium
+
+              * Refreshed dependencies
+              * Added foo to desktop
+                (LP: #1)
+
+
+             -- Jane Doe <jane@example.org>  Thu, 15 Oct 2026 10:00:00 +0000
+
+            """) + _OLD_ENTRY)
+        add_changelog_items(
+            ["Removed bar from desktop"], changelog="changelog")
+        self.assertEqual(textwrap.dedent("""\
+            ubuntu-meta (1.1) UNRELEASED; urgency=medium
+
+              * Refreshed dependencies
+              * Added foo to desktop
+                (LP: #1)
+              * Removed bar from desktop
+
+
+             -- Jane Doe <jane@example.org>  Thu, 15 Oct 2026 10:00:00 +0000
+
+            """) + _OLD_ENTRY, self.read_changelog())
+
+    def test_long_items(self):
+        """Long items are wrapped as dch wraps them."""
+        self.write_changelog(textwrap.dedent("""\
+            ubuntu-meta (1.1) UNRELEASED; urgency=medium
+
+              * Refreshed dependencies
+
+             -- Jane Doe <jane@example.org>  Thu, 15 Oct 2026 10:00:00 +0000
+            """))
+        add_changelog_items(
+            ["Added gnome-shell-extension-desktop-icons-ng, "
+             "gnome-shell-extension-appindicator, "
+             "gnome-shell-extension-ubuntu-dock to desktop-recommends "
+             "[amd64 arm64 armhf ppc64el riscv64 s390x]"],
+            changelog="changelog")
+        self.assertEqual(
+            "ubuntu-meta (1.1) UNRELEASED; urgency=medium\n"
+            "\n"
+            "  * Refreshed dependencies\n"
+            "  * Added gnome-shell-extension-desktop-icons-ng,\n"
+            "    gnome-shell-extension-appindicator, "
+            "gnome-shell-extension-ubuntu-dock to\n"
+            "    desktop-recommends "
+            "[amd64 arm64 armhf ppc64el riscv64 s390x]\n"
+            "\n"
+            " -- Jane Doe <jane@example.org>  "
+            "Thu, 15 Oct 2026 10:00:00 +0000\n",
+            self.read_changelog())
+
+
+class TestRunArchitecture(TestCase):
+    def setUp(self):
+        super(TestRunArchitecture, self).setUp()
+        self.stdout = io.StringIO()
+        self.addCleanup(setattr, sys, "stdout", sys.stdout)
+        sys.stdout = self.stdout
+        # Stand in for the handler that germinate_logging sets up.
+        self.handler = logging.StreamHandler(sys.stdout)
+        logging.getLogger("germinate").addHandler(self.handler)
+        self.addCleanup(
+            logging.getLogger("germinate").removeHandler, self.handler)
+        self.logger = logging.getLogger("germinate.test")
+        self.addCleanup(
+            setattr, germinate_update_metapackage, "_process_architecture",
+            germinate_update_metapackage._process_architecture)
+
+    def test_collects_output(self):
+        """Printed and logged output is returned rather than written."""
+        def process_architecture(architecture):
+            print("printed %s" % architecture)
+            self.logger.warning("logged %s", architecture)
+            return architecture
+
+        germinate_update_metapackage._process_architecture = (
+            process_architecture)
+        self.assertEqual(
+            ("printed i386\nlogged i386\n", "i386"),
+            germinate_update_metapackage._run_architecture("i386"))
+        self.assertEqual("", self.stdout.getvalue())
+        self.assertIs(self.stdout, sys.stdout)
+        self.assertIs(self.stdout, self.handler.stream)
+
+    def test_failure_writes_output(self):
+        """Output collected before a failure is written out."""
+        def process_architecture(architecture):
+            print("printed %s" % architecture)
+            self.logger.warning("logged %s", architecture)
+            raise ValueError
+
+        germinate_update_metapackage._process_architecture = (
+            process_architecture)
+        self.assertRaises(
+            ValueError, germinate_update_metapackage._run_architecture, "i386")
+        self.assertEqual("printed i386\nlogged i386\n", self.stdout.getvalue())
+        self.assertIs(self.stdout, self.handler.stream)
+
+    @unittest.skipIf(fetch._http is None, "urllib3 not available")
+    def test_fresh_connection_pool(self):
+        """Workers do not use the parent's pooled HTTP connections."""
+        self.addCleanup(setattr, fetch, "_http", fetch._http)
+        pool = fetch._http
+        germinate_update_metapackage._process_architecture = (
+            lambda architecture: fetch._http)
+        _, worker_pool = germinate_update_metapackage._run_architecture(
+            "i386")
+        self.assertIsNotNone(worker_pool)
+        self.assertIsNot(pool, worker_pool)
+
+
+class TestSkipping(TestCase):
+    def test_unindented(self):
+        """Skipped packages are logged without the debug indentation."""
+        stream = io.StringIO()
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(GerminateFormatter())
+        logger = logging.getLogger("germinate")
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        self.addCleanup(logger.setLevel, logger.level)
+        logger.setLevel(logging.DEBUG)
+        germinate_update_metapackage._skipping(
+            "minimal", "i386", "foo", "essential")
+        self.assertEqual(
+            "minimal/i386: Skipping package foo (essential)\n",
+            stream.getvalue())
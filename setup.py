@@ -2,12 +2,14 @@
 
 import os
 import re
+import shutil
 import subprocess
 import sys
 
+from distutils import log
 from distutils.command.build import build
 from distutils.command.clean import clean
-from setuptools import setup, Command, find_packages
+from setuptools import setup, Command
 from setuptools.command.install import install
 from setuptools.command.test import test
 
@@ -77,8 +79,13 @@ class install_extra(install):
     def run(self):
         install.run(self)
 
-        self.spawn(['sed', '-i', 's/@VERSION@/%s/' % germinate_version,
-                    os.path.join(self.install_lib, 'germinate', 'version.py')])
+        version_py = os.path.join(self.install_lib, 'germinate', 'version.py')
+        log.info("substituting version in %s", version_py)
+        if not self.dry_run:
+            with open(version_py) as f:
+                contents = f.read()
+            with open(version_py, 'w') as f:
+                f.write(contents.replace('@VERSION@', germinate_version))
 
 
 class clean_extra(clean):
@@ -90,22 +97,32 @@ class clean_extra(clean):
                 if dirs[i].startswith('.') or dirs[i] == 'debian':
                     del dirs[i]
                 elif dirs[i] == '__pycache__' or dirs[i].endswith('.egg-info'):
-                    self.spawn(['rm', '-r', os.path.join(path, dirs[i])])
+                    d = os.path.join(path, dirs[i])
+                    log.info("removing '%s' (and everything under it)", d)
+                    if not self.dry_run:
+                        shutil.rmtree(d)
                     del dirs[i]
 
             for f in files:
                 f = os.path.join(path, f)
-                if f.endswith('.pyc'):
-                    self.spawn(['rm', f])
-                elif f.startswith('./debhelper') and f.endswith('.1'):
-                    self.spawn(['rm', f])
-
-
-perl_vendorlib = subprocess.Popen(
-    ['perl', '-MConfig', '-e', 'print $Config{vendorlib}'],
-    stdout=subprocess.PIPE, universal_newlines=True).communicate()[0]
-if not perl_vendorlib:
-    raise ValueError("Failed to get $Config{vendorlib} from perl")
+                if (f.endswith('.pyc') or
+                        (f.startswith('./debhelper') and f.endswith('.1'))):
+                    log.info("removing '%s'", f)
+                    if not self.dry_run:
+                        os.unlink(f)
+
+
+# Debian policy fixes perl's vendorlib at /usr/share/perl5, so if
+# debhelper's sequence directory is there we can avoid starting perl (which
+# would otherwise happen for every setup.py command) to ask it.
+if os.path.isdir('/usr/share/perl5/Debian/Debhelper/Sequence'):
+    perl_vendorlib = '/usr/share/perl5'
+else:
+    perl_vendorlib = subprocess.Popen(
+        ['perl', '-MConfig', '-e', 'print $Config{vendorlib}'],
+        stdout=subprocess.PIPE, universal_newlines=True).communicate()[0]
+    if not perl_vendorlib:
+        raise ValueError("Failed to get $Config{vendorlib} from perl")
 perllibdir = '%s/Debian/Debhelper/Sequence' % perl_vendorlib
 
 
@@ -119,7 +136,7 @@ setup(
     maintainer_email='cjwatson@ubuntu.com',
     url='https://wiki.ubuntu.com/Germinate',
     license='GNU GPL',
-    packages=find_packages(),
+    packages=['germinate', 'germinate.scripts', 'germinate.tests'],
     scripts=[
         'bin/germinate',
         'bin/germinate-pkg-diff',